@@ -4,6 +4,8 @@ import os
 from yaml import load, dump, CLoader, CDumper
 from yaml.constructor import Constructor
 
+from project.utils import columnar
+
 
 # Deal with Yaml 1.2 and 1.1 incompatibilty: Turn off 'on' == True (bool)
 def add_bool(self, node):
@@ -17,23 +19,52 @@ DataTuple.__str__ = lambda s: "Name: {} | Tr: {}, Vd: {}, Te: {}".format(
     s.name, len(s.train), len(s.valid), len(s.test))
 
 
-def load_data(prefix, name, validation=0.3):
+SPLITS = ['train', 'valid', 'test']
+
+
+def _split_files(prefix, name):
     dirname = os.path.dirname(os.path.abspath(__file__))
-    train_file = '{}/{}/{}_train.yaml'.format(dirname, prefix, name)
-    valid_file = '{}/{}/{}_valid.yaml'.format(dirname, prefix, name)
-    test_file = '{}/{}/{}_test.yaml'.format(dirname, prefix, name)
-
-    if os.path.isfile(train_file) and os.path.isfile(test_file):
-        with open(train_file, 'r', encoding='utf-8') as f:
-            train = load(f, Loader=CLoader)
-        with open(valid_file, 'r', encoding='utf-8') as f:
-            valid = load(f, Loader=CLoader)
-        with open(test_file, 'r', encoding='utf-8') as f:
-            test = load(f, Loader=CLoader)
+    return ['{}/{}/{}_{}'.format(dirname, prefix, name, s) for s in SPLITS]
+
+
+def _load_yaml_split(filename):
+    with open(filename, 'r', encoding='utf-8') as f:
+        return load(f, Loader=CLoader)
+
+
+def load_data(prefix, name, validation=0.3):
+    train_file, valid_file, test_file = _split_files(prefix, name)
+
+    if all(columnar.is_columnar(f + columnar.COLUMNAR_SUFFIX) for f in [train_file, valid_file, test_file]):
+        train, valid, test = [columnar.load_records(f + columnar.COLUMNAR_SUFFIX)
+                              for f in [train_file, valid_file, test_file]]
+        return DataTuple(train, valid, test, prefix)
+    elif os.path.isfile(train_file + '.yaml') and os.path.isfile(test_file + '.yaml'):
+        train, valid, test = [_load_yaml_split(f + '.yaml')
+                              for f in [train_file, valid_file, test_file]]
         return DataTuple(train, valid, test, prefix)
     else:
         return None
 
+
+def convert_to_columnar(prefix=None):
+    '''One-shot conversion of existing yaml splits into the columnar format.
+    Converts every dataset in the preprocessed directory, or only `prefix`.'''
+    dirname = os.path.dirname(os.path.abspath(__file__))
+    prefixes = [prefix] if prefix is not None else sorted(
+        p for p in os.listdir(dirname) if os.path.isdir(os.path.join(dirname, p)))
+
+    for p in prefixes:
+        for filename in sorted(os.listdir(os.path.join(dirname, p))):
+            if not filename.endswith('_train.yaml'):
+                continue
+            name = filename[:-len('_train.yaml')]
+            for f in _split_files(p, name):
+                if not os.path.isfile(f + '.yaml'):
+                    continue
+                print("CONVERTING {}".format(os.path.basename(f)))
+                columnar.save_records(_load_yaml_split(f + '.yaml'), f + columnar.COLUMNAR_SUFFIX)
+
 def load_vocab(name, subname=None):
     dirname = os.path.dirname(os.path.abspath(__file__))
     if not os.path.exists(dirname+'/'+name):
@@ -92,12 +123,8 @@ def save_data(train_data, test_data, name, subname=None):
     s = [len(train_data), len(valid_data), len(unseen_test_data)]
     r = ["{:.5f}".format(x/sum(s)) for x in s]
     print("SAVING Name: {}, Ratio: {}, Args: {}".format(filename, r, s))
-    with open(dirname+"/{}/{}_train.yaml".format(name, filename), 'w', encoding='utf-8') as f:
-        f.write(dump(train_data, Dumper=CDumper))
-    with open(dirname+"/{}/{}_valid.yaml".format(name, filename), 'w', encoding='utf-8') as f:
-        f.write(dump(valid_data, Dumper=CDumper))
-    with open(dirname+"/{}/{}_test.yaml".format(name, filename), 'w', encoding='utf-8') as f:
-        f.write(dump(unseen_test_data,  Dumper=CDumper))
+    for split_file, split_data in zip(_split_files(name, filename), [train_data, valid_data, unseen_test_data]):
+        columnar.save_records(split_data, split_file + columnar.COLUMNAR_SUFFIX)
     with open(dirname+"/{}/__init__.py".format(name), 'w', encoding='utf-8') as f:
         l = 'from project.data.preprocessed import load_data\n\n{}'.format(import_stmt)
         f.write(l)
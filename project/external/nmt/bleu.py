@@ -22,8 +22,11 @@ evaluation metrics for machine translation. COLING 2004.
 """
 
 import collections
+import itertools
 import math
 
+import numpy as np
+
 
 def _get_ngrams(segment, max_order):
   """Extracts all n-grams upto a given maximum order from an input segment.
@@ -45,68 +48,291 @@ def _get_ngrams(segment, max_order):
   return ngram_counts
 
 
-def compute_bleu(reference_corpus, translation_corpus, max_order=4,
-                 smooth=False):
-  """Computes BLEU score of translated segments against one or more references.
+def get_reference_ngrams(reference_corpus, max_order=4):
+  """Precomputes the reference side of BLEU, to score many translations of
+  the same references.
 
   Args:
     reference_corpus: list of lists of references for each translation. Each
         reference should be tokenized into a list of tokens.
-    translation_corpus: list of translations to score. Each translation
-        should be tokenized into a list of tokens.
-    max_order: Maximum n-gram order to use when computing BLEU score.
-    smooth: Whether or not to apply Lin et al. 2004 smoothing.
+    max_order: maximum n-gram order to use.
 
   Returns:
-    3-Tuple with the BLEU score, n-gram precisions, geometric mean of n-gram
-    precisions and brevity penalty.
+    List with, for each entry of reference_corpus, a tuple of the shortest
+    reference length and the merged reference n-gram Counter.
   """
-  matches_by_order = [0] * max_order
-  possible_matches_by_order = [0] * max_order
-  reference_length = 0
-  translation_length = 0
-  for (references, translation) in zip(reference_corpus,
-                                       translation_corpus):
-    reference_length += min(len(r) for r in references)
-    translation_length += len(translation)
-
+  reference_ngrams = []
+  for references in reference_corpus:
     merged_ref_ngram_counts = collections.Counter()
     for reference in references:
       merged_ref_ngram_counts |= _get_ngrams(reference, max_order)
-    translation_ngram_counts = _get_ngrams(translation, max_order)
-    overlap = translation_ngram_counts & merged_ref_ngram_counts
-    for ngram in overlap:
-      matches_by_order[len(ngram)-1] += overlap[ngram]
-    for order in range(1, max_order+1):
-      possible_matches = len(translation) - order + 1
-      if possible_matches > 0:
-        possible_matches_by_order[order-1] += possible_matches
-
-  precisions = [0] * max_order
-  for i in range(0, max_order):
-    if smooth:
-      precisions[i] = ((matches_by_order[i] + 1.) /
-                       (possible_matches_by_order[i] + 1.))
-    else:
-      if possible_matches_by_order[i] > 0:
-        precisions[i] = (float(matches_by_order[i]) /
-                         possible_matches_by_order[i])
+    reference_ngrams.append(
+        (min(len(r) for r in references), merged_ref_ngram_counts))
+  return reference_ngrams
+
+
+def _flatten(corpus):
+  """Interns the tokens of a list of segments as int ids.
+
+  Returns:
+    ids (int64 array of every token), offsets ([n+1] segment boundaries) and
+    the number of distinct ids.
+  """
+  offsets = np.zeros(len(corpus) + 1, dtype=np.int64)
+  np.cumsum([len(s) for s in corpus], out=offsets[1:])
+  flat = list(itertools.chain.from_iterable(corpus))
+
+  tokens = np.array(flat) if flat else np.zeros(0, dtype=np.int64)
+  if tokens.ndim == 1 and (
+      tokens.dtype.kind in "iu" or
+      (tokens.dtype.kind == "U" and all(isinstance(t, str) for t in flat))):
+    uniques, ids = np.unique(tokens, return_inverse=True)
+    return ids.reshape(-1).astype(np.int64), offsets, len(uniques)
+
+  vocab = {}
+  ids = np.fromiter((vocab.setdefault(t, len(vocab)) for t in flat),
+                    dtype=np.int64, count=len(flat))
+  return ids, offsets, len(vocab)
+
+
+def _ngram_codes(ids, prev_codes, order, base):
+  """Encodes the n-gram of one order starting at every position of ids as an
+  int: the dense rank of the (order-1)-gram there, times base, plus the last
+  token. Ranks are below len(ids), so codes stay below len(ids) * base
+  whatever the order (n-grams running past a segment are encoded too, and
+  masked by the caller).
+
+  Returns:
+    The codes of the len(ids) - order + 1 first positions.
+  """
+  if order == 1:
+    return ids
+  n = max(len(ids) - order + 1, 0)
+  _, rank = np.unique(prev_codes, return_inverse=True)
+  return rank.reshape(-1)[:n] * base + ids[order-1:order-1+n]
+
+
+def _match_sorted(a, b):
+  """Indices into a and into b of the values both sorted unique arrays hold."""
+  if not len(a) or not len(b):
+    return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+  pos = np.minimum(np.searchsorted(b, a), len(b) - 1)
+  found = b[pos] == a
+  return np.nonzero(found)[0], pos[found]
+
+
+def _max_by_key(keys, values):
+  """The unique keys and the largest value for each."""
+  order = np.lexsort([values, keys])
+  keys, values = keys[order], values[order]
+  last = np.ones(len(keys), dtype=bool)
+  last[:-1] = keys[1:] != keys[:-1]
+  return keys[last], values[last]
+
+
+def _numpy_statistics(reference_corpus, translation_corpus, max_order):
+  """The BLEU statistics of compute_bleu, with n-grams counted as int codes
+  in numpy arrays. Returns None if the codes could overflow int64, which
+  needs len(tokens) * distinct tokens >= 2**63, i.e. billions of tokens.
+  """
+  n = min(len(reference_corpus), len(translation_corpus))
+  reference_corpus = reference_corpus[:n]
+  translation_corpus = translation_corpus[:n]
+
+  references = [r for refs in reference_corpus for r in refs]
+  ref_segment = np.repeat(np.arange(n),
+                          [len(refs) for refs in reference_corpus])
+
+  # One id space, and one flat array, for both sides
+  ids, offsets, base = _flatten(references + list(translation_corpus))
+  base = max(base, 1)
+  if len(ids) * base >= 2 ** 63:
+    return None
+  lengths = np.diff(offsets)
+  # Segment of every position and where that segment ends
+  position_segment = np.repeat(np.arange(len(lengths)), lengths)
+  segment_end = np.repeat(offsets[1:], lengths)
+  is_translation = position_segment >= len(references)
+  trans_lengths = lengths[len(references):]
+
+  matches_by_order = [0] * max_order
+  possible_matches_by_order = [0] * max_order
+  codes = None
+  for order in range(1, max_order + 1):
+    codes = _ngram_codes(ids, codes, order, base)
+    m = len(codes)
+    within = np.arange(m) + order <= segment_end[:m]
+    t_mask = within & is_translation[:m]
+    r_mask = within & ~is_translation[:m]
+    t_seg = position_segment[:m][t_mask] - len(references)
+    t_codes = codes[t_mask]
+    r_ref = position_segment[:m][r_mask]
+    r_codes = codes[r_mask]
+
+    # Renumber the n-grams densely, so (segment, n-gram) fits one int64 key
+    _, ngram = np.unique(np.concatenate([t_codes, r_codes]),
+                         return_inverse=True)
+    ngram = ngram.reshape(-1)
+    n_ngrams = int(ngram.max()) + 1 if len(ngram) else 1
+    t_ngram, r_ngram = ngram[:len(t_codes)], ngram[len(t_codes):]
+
+    t_keys, t_counts = np.unique(t_seg * n_ngrams + t_ngram,
+                                 return_counts=True)
+    # Count per reference, then take the max over each segment's references
+    r_keys, r_counts = np.unique(r_ref * n_ngrams + r_ngram,
+                                 return_counts=True)
+    r_keys = ref_segment[r_keys // n_ngrams] * n_ngrams + r_keys % n_ngrams
+    r_keys, r_counts = _max_by_key(r_keys, r_counts)
+
+    t_idx, r_idx = _match_sorted(t_keys, r_keys)
+    matches_by_order[order-1] = int(
+        np.minimum(t_counts[t_idx], r_counts[r_idx]).sum())
+    possible_matches_by_order[order-1] = int(
+        np.maximum(trans_lengths - order + 1, 0).sum())
+
+  reference_length = sum(min(len(r) for r in refs)
+                         for refs in reference_corpus)
+  translation_length = int(trans_lengths.sum())
+  return (matches_by_order, possible_matches_by_order, reference_length,
+          translation_length)
+
+
+class BleuAccumulator(object):
+  """Accumulates the statistics corpus BLEU is computed from.
+
+  Batches of translations can be added with `update` (and then discarded),
+  accumulators from different processes combined with `merge`, and
+  `result` gives exactly what compute_bleu gives on the whole corpus.
+
+  With backend="numpy" n-grams are counted as int codes in numpy arrays
+  rather than as Counters of tuples; the statistics are identical. Codes
+  are bounded by len(tokens) * distinct tokens, not by the vocabulary size
+  to the power max_order, so only corpora of billions of tokens fall back
+  to Counters. Works with numpy 1.14.
+  """
+
+  def __init__(self, max_order=4, backend="counter"):
+    self.max_order = max_order
+    self.backend = backend
+    self.matches_by_order = [0] * max_order
+    self.possible_matches_by_order = [0] * max_order
+    self.reference_length = 0
+    self.translation_length = 0
+
+  def update(self, reference_corpus, translation_corpus,
+             reference_ngrams=None):
+    """Adds a batch of translations.
+
+    Args:
+      reference_corpus: list of lists of references for each translation.
+          Ignored if reference_ngrams is given.
+      translation_corpus: list of translations to score.
+      reference_ngrams: optional output of get_reference_ngrams for the
+          references (with the same max_order).
+
+    Returns:
+      self
+    """
+    if reference_ngrams is None and self.backend == "numpy":
+      statistics = _numpy_statistics(reference_corpus, translation_corpus,
+                                     self.max_order)
+      if statistics is not None:
+        return self._add(*statistics)
+
+    if reference_ngrams is None:
+      reference_ngrams = get_reference_ngrams(reference_corpus,
+                                              self.max_order)
+    for ((reference_length, merged_ref_ngram_counts),
+         translation) in zip(reference_ngrams, translation_corpus):
+      self.reference_length += reference_length
+      self.translation_length += len(translation)
+
+      translation_ngram_counts = _get_ngrams(translation, self.max_order)
+      overlap = translation_ngram_counts & merged_ref_ngram_counts
+      for ngram in overlap:
+        self.matches_by_order[len(ngram)-1] += overlap[ngram]
+      for order in range(1, self.max_order+1):
+        possible_matches = len(translation) - order + 1
+        if possible_matches > 0:
+          self.possible_matches_by_order[order-1] += possible_matches
+    return self
+
+  def _add(self, matches_by_order, possible_matches_by_order,
+           reference_length, translation_length):
+    for i in range(self.max_order):
+      self.matches_by_order[i] += matches_by_order[i]
+      self.possible_matches_by_order[i] += possible_matches_by_order[i]
+    self.reference_length += reference_length
+    self.translation_length += translation_length
+    return self
+
+  def merge(self, other):
+    """Adds the statistics of another accumulator. Returns self."""
+    assert self.max_order == other.max_order
+    return self._add(other.matches_by_order, other.possible_matches_by_order,
+                     other.reference_length, other.translation_length)
+
+  def result(self, smooth=False):
+    """Computes the BLEU score of everything added so far.
+
+    Args:
+      smooth: Whether or not to apply Lin et al. 2004 smoothing.
+
+    Returns:
+      The same tuple as compute_bleu.
+    """
+    max_order = self.max_order
+    matches_by_order = self.matches_by_order
+    possible_matches_by_order = self.possible_matches_by_order
+
+    precisions = [0] * max_order
+    for i in range(0, max_order):
+      if smooth:
+        precisions[i] = ((matches_by_order[i] + 1.) /
+                         (possible_matches_by_order[i] + 1.))
       else:
-        precisions[i] = 0.0
+        if possible_matches_by_order[i] > 0:
+          precisions[i] = (float(matches_by_order[i]) /
+                           possible_matches_by_order[i])
+        else:
+          precisions[i] = 0.0
 
-  if min(precisions) > 0:
-    p_log_sum = sum((1. / max_order) * math.log(p) for p in precisions)
-    geo_mean = math.exp(p_log_sum)
-  else:
-    geo_mean = 0
+    if min(precisions) > 0:
+      p_log_sum = sum((1. / max_order) * math.log(p) for p in precisions)
+      geo_mean = math.exp(p_log_sum)
+    else:
+      geo_mean = 0
+
+    ratio = float(self.translation_length) / self.reference_length
+
+    if ratio > 1.0:
+      bp = 1.
+    else:
+      bp = math.exp(1 - 1. / ratio)
+
+    bleu = geo_mean * bp
 
-  ratio = float(translation_length) / reference_length
+    return (bleu, precisions, bp, ratio, self.translation_length,
+            self.reference_length)
 
-  if ratio > 1.0:
-    bp = 1.
-  else:
-    bp = math.exp(1 - 1. / ratio)
 
-  bleu = geo_mean * bp
+def compute_bleu(reference_corpus, translation_corpus, max_order=4,
+                 smooth=False, backend="counter"):
+  """Computes BLEU score of translated segments against one or more references.
 
-  return (bleu, precisions, bp, ratio, translation_length, reference_length)
+  Args:
+    reference_corpus: list of lists of references for each translation. Each
+        reference should be tokenized into a list of tokens.
+    translation_corpus: list of translations to score. Each translation
+        should be tokenized into a list of tokens.
+    max_order: Maximum n-gram order to use when computing BLEU score.
+    smooth: Whether or not to apply Lin et al. 2004 smoothing.
+    backend: "counter" or "numpy", see BleuAccumulator.
+
+  Returns:
+    3-Tuple with the BLEU score, n-gram precisions, geometric mean of n-gram
+    precisions and brevity penalty.
+  """
+  accumulator = BleuAccumulator(max_order, backend)
+  accumulator.update(reference_corpus, translation_corpus)
+  return accumulator.result(smooth)
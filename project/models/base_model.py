@@ -2,6 +2,7 @@ import abc
 from collections import namedtuple
 import logging
 import sys
+import time
 
 # from nltk.translate.bleu_score import corpus_bleu, SmoothingFunction
 import numpy as np
@@ -10,8 +11,9 @@ import tensorflow as tf
 from project.external.nmt import bleu
 import project.utils.logging as log_util
 import project.utils.saveload as saveload
-from project.utils.tokenize import START_OF_TEXT_TOKEN, \
-                         get_embed_tuple_and_data_tuple
+from project.utils import batching
+from project.utils.tokenize import get_embed_tuple_and_data_tuple, \
+                         lookup_array, detokenize
 
 LOGGER = logging.getLogger('')
 
@@ -37,15 +39,38 @@ ArgumentSummary = namedtuple("ArgumentSummary", arg_sum)
 ArgumentSummary.__str__ = lambda s: ARGUMENT_SUMMARY_STRING.format(
   nn=s.nn, kwargs="\n".join(["{} : {}".format(k,v) for k,v in sorted(s.kwargs.items())]))
 
+EVAL_ARGS = ['eval_every', 'eval_points', 'eval_poll_secs', 'beam_width', 'length_penalty', 'max_decode_len']
+# Where evaluate_checkpoints keeps the checkpoint it is evaluating
+EVAL_SNAPSHOT_DIR = 'eval_snapshot'
+# The values a checkpoint has to beat to be backed up as the best so far
+INITIAL_BEST = {'best_cross_ent': 1e8, 'best_bleu': 0, 'best_perp': 1e8}
+
 np.random.seed(100)
 
 class BasicRNNModel(abc.ABC):
 
     summary_string = 'MODEL: {classname}\nName: {name}\n\n{summary}'
 
-    def __init__(self, embed_tuple, name="BasicModel"):
+    def __init__(self, embed_tuple, model_name="BasicModel", batch_sampler="shuffle", prefetch_depth=2,
+                 input_mode="feed", beam_width=1, length_penalty=0.0, max_decode_len=300,
+                 inference_only=False, **_):
         # To Do; all these args from config, to make saving model easier.
-        self.name = name
+        self.name = model_name
+        self.batch_sampler = batch_sampler
+        self.prefetch_depth = prefetch_depth
+        self.input_mode = input_mode
+        self.beam_width = beam_width
+        self.length_penalty = length_penalty
+        self.max_decode_len = max_decode_len
+        # Only decode (e.g. for serving): no optimiser is built
+        self.inference_only = inference_only
+
+        # (column, tensor) for every minibatch column the graph reads
+        self.input_tensors = []
+        # Graph input mode: rows of the data held in the graph to look up
+        self.batch_index = None
+        self._graph_data = []
+        self._data_offsets = {}
 
         self.word_weights = embed_tuple.word_weights
         self.char_weights = embed_tuple.char_weights
@@ -54,6 +79,8 @@ class BasicRNNModel(abc.ABC):
         self.idx2word = dict((v, k) for k, v in embed_tuple.word2idx.items())
         self.char2idx = embed_tuple.char2idx
         self.idx2char = dict((v, k) for k, v in embed_tuple.char2idx.items())
+        self.idx2word_array = lookup_array(self.idx2word)
+        self.idx2char_array = lookup_array(self.idx2char)
 
         self.input_data_sequence = None
         self.input_label_sequence = None
@@ -66,6 +93,10 @@ class BasicRNNModel(abc.ABC):
         self.inference_loss = None
         self.inference_id = None
 
+        # Beam search (beam_width > 1): fed as beam_width when beam_id is run
+        self.beam_multiplier = None
+        self.beam_id = None
+
         self._do_shuffle = True
 
     @abc.abstractmethod
@@ -215,7 +246,7 @@ class BasicRNNModel(abc.ABC):
 
     @staticmethod
     def _build_rnn_greedy_inference_decoder(decoder_rnn_cell, state, projection_layer, decoder_weights,
-                                            start_tok, end_tok, use_attention=True):
+                                            start_tok, end_tok, use_attention=True, maximum_iterations=300):
         with tf.variable_scope("inference", reuse=tf.AUTO_REUSE):
             batch_size = tf.shape(state[0])[0]
 
@@ -231,10 +262,50 @@ class BasicRNNModel(abc.ABC):
                 decoder_rnn_cell, helper, decoder_initial_state,
                 output_layer=projection_layer)
 
-            maximum_iterations = 300
             return tf.contrib.seq2seq.dynamic_decode(
                 decoder, impute_finished=True, maximum_iterations=maximum_iterations)
 
+    def _beam_tiled(self, tensor):
+        '''tensor repeated beam_multiplier times per example, for the memory of an
+        attention mechanism. The multiplier is 1 unless beam_id is run, so the
+        training, greedy and beam search decoders share one attention mechanism.'''
+        if self.beam_width <= 1:
+            return tensor
+        if self.beam_multiplier is None:
+            self.beam_multiplier = tf.placeholder_with_default(1, shape=(), name="beam_multiplier")
+        return tf.contrib.seq2seq.tile_batch(tensor, self.beam_multiplier)
+
+    def _build_rnn_beam_search_decoder(self, decoder_rnn_cell, state, projection_layer, decoder_weights,
+                                       start_tok, end_tok, use_attention=True):
+        '''[batch_size x time] ids of the best beam, zeroed after its first end_tok
+        like the greedy sample ids, or None if beam_width <= 1. Attention memory
+        must be built with _beam_tiled.'''
+        if self.beam_width <= 1:
+            return None
+
+        with tf.variable_scope("beam_inference", reuse=tf.AUTO_REUSE):
+            batch_size = tf.shape(state[0])[0]
+            tiled_state = tf.contrib.seq2seq.tile_batch(state, self.beam_width)
+
+            if use_attention:
+                decoder_initial_state = decoder_rnn_cell.zero_state(
+                    batch_size * self.beam_width, dtype=tf.float32).clone(cell_state=tiled_state)
+            else:
+                decoder_initial_state = tiled_state
+
+            decoder = tf.contrib.seq2seq.BeamSearchDecoder(
+                decoder_rnn_cell, decoder_weights, tf.fill([batch_size], start_tok), end_tok,
+                decoder_initial_state, self.beam_width, output_layer=projection_layer,
+                length_penalty_weight=self.length_penalty)
+
+            outputs, _, _ = tf.contrib.seq2seq.dynamic_decode(
+                decoder, maximum_iterations=self.max_decode_len)
+
+            # Finished beams keep emitting end_tok
+            best = outputs.predicted_ids[:, :, 0]
+            ended = tf.cumsum(tf.cast(tf.equal(best, end_tok), tf.int32), axis=1, exclusive=True) > 0
+            return tf.where(ended, tf.zeros_like(best), best)
+
     @staticmethod
     def _get_loss(logits, input_label_sequence, input_label_seq_length):
         with tf.variable_scope("loss", reuse=tf.AUTO_REUSE):
@@ -285,67 +356,152 @@ class BasicRNNModel(abc.ABC):
         else:
             return [lookup[i] for i in translate_id]
 
+    def _input_tensor(self, column, name, ragged=False):
+        '''[batch_size x max_length] int32 input, taken from the given column of
+        the minibatches. In feed mode this is a placeholder. In graph mode the
+        rows at batch_index are gathered from the data stored in the graph
+        (trimmed to the longest row + 1), but can still be fed directly.'''
+        if self.input_mode != 'graph':
+            tensor = tf.placeholder(tf.int32, [None, None], name)
+            self.input_tensors.append((column, tensor))
+            return tensor
+
+        if self.batch_index is None:
+            self.batch_index = tf.placeholder(tf.int32, [None], "batch_index")
+
+        with tf.variable_scope("graph_data_{}".format(column)):
+            if ragged:
+                init_values = tf.placeholder(tf.int32, [None], "init_values")
+                init_offsets = tf.placeholder(tf.int64, [None], "init_offsets")
+                values = tf.Variable(init_values, trainable=False, collections=[],
+                                     validate_shape=False, name="values")
+                offsets = tf.Variable(init_offsets, trainable=False, collections=[],
+                                      validate_shape=False, name="offsets")
+                self._graph_data.append((column, ragged, [init_values, init_offsets], [values, offsets]))
+
+                starts = tf.gather(offsets, self.batch_index)
+                lengths = tf.gather(offsets, self.batch_index + 1) - starts
+                positions = tf.range(tf.reduce_max(lengths) + 1)
+                in_row = positions[None, :] < lengths[:, None]
+                value_idx = tf.where(in_row, starts[:, None] + positions[None, :], tf.zeros_like(in_row, tf.int64))
+                rows = tf.where(in_row, tf.gather(values, value_idx), tf.zeros_like(value_idx, tf.int32))
+            else:
+                init_rows = tf.placeholder(tf.int32, [None, None], "init_rows")
+                all_rows = tf.Variable(init_rows, trainable=False, collections=[],
+                                       validate_shape=False, name="rows")
+                self._graph_data.append((column, ragged, [init_rows], [all_rows]))
+
+                rows = tf.gather(all_rows, self.batch_index)
+                lengths = tf.argmax(tf.cast(tf.equal(rows, 0), tf.int32), axis=1, output_type=tf.int32)
+                rows = rows[:, :tf.reduce_max(lengths) + 1]
+
+        tensor = tf.placeholder_with_default(rows, [None, None], name)
+        self.input_tensors.append((column, tensor))
+        return tensor
+
+    def load_graph_data(self, session, data_tuple):
+        '''Copy the train, valid and test tensors into the graph (once), for the
+        graph input mode.'''
+        splits = [data_tuple.train, data_tuple.valid, data_tuple.test]
+        self._data_offsets, offset = {}, 0
+        for split in splits:
+            self._data_offsets[id(split[0])] = offset
+            offset += len(split[0])
+
+        for column, ragged, inits, variables in self._graph_data:
+            data = batching.concat_columns([split[column] for split in splits])
+            values = [data.values, data.offsets] if ragged else [data]
+            session.run([v.initializer for v in variables],
+                        feed_dict=dict(zip(inits, values)))
+
+    def _split_offset(self, full_data):
+        '''Where full_data starts in the data held in the graph, or None to feed
+        the minibatches.'''
+        if self.input_mode != 'graph':
+            return None
+        return self._data_offsets.get(id(full_data[0]))
+
     def _feed_fwd(self, session, minibatch_data, operation, mode=None):
         """
         Evaluates a node in the graph
         Args
             session: session that is being run
-            input_data, array: batch of comments
-            input_labels, array: batch of labels
+            minibatch_data: tuple of the minibatch columns, or an IndexedBatch
+                            of rows of the data held in the graph
             operation: node in graph to be evaluated
         Returns
             output of the operation
         """
         run_ouputs = operation
-        feed_dict = {self.input_data_sequence: minibatch_data[0],
-                     self.input_label_sequence: minibatch_data[1]}
+        if isinstance(minibatch_data, batching.IndexedBatch):
+            feed_dict = {self.batch_index: minibatch_data.index}
+        else:
+            feed_dict = {t: minibatch_data[c] for c, t in self.input_tensors}
         if mode == 'TRAIN':
             feed_dict[self.dropout_keep_prob] = 1 - self.dropout
+        elif mode == 'BEAM' and self.beam_multiplier is not None:
+            feed_dict[self.beam_multiplier] = self.beam_width
 
         return session.run(run_ouputs, feed_dict=feed_dict)
 
-    def _to_batch(self, full_data, epochs=1, do_prog_bar=False):
-        # arg_name, arg_desc, arg_code = full_data
-        # assert arg_name.shape[0] == arg_desc.shape[0]
-        size = full_data[0].shape[0]
-
-        batch_per_epoch = (size // self.batch_size) + 1
+    def _shuffled_batches(self, full_data, offset, index_only):
+        # Ragged fields are padded to the widest row in each minibatch
+        return batching.shuffled_batches(full_data, self.batch_size, self._do_shuffle,
+                                         offset=offset, index_only=index_only)
+
+    def _bucketed_batches(self, full_data, lengths, offset, index_only):
+        # Bucket on arg_name then arg_desc length, and trim every padded field
+        # to the longest row in the batch
+        for idx in batching.bucket_batches(lengths[:2], self.batch_size):
+            yield batching.make_batch(full_data, idx, lengths, offset, index_only)
+
+    def _to_batch(self, full_data, epochs=1, do_prog_bar=False, sampler='shuffle', index_only=False, offset=None):
+        '''Yield (epoch, minibatch). In graph input mode minibatches of data held
+        in the graph (starting at offset) are IndexedBatches, with no columns
+        if index_only.'''
+        if offset is None:
+            offset = self._split_offset(full_data)
+        index_only = index_only and offset is not None
+
+        bucket = (sampler == 'bucket' and self._do_shuffle)
+        if bucket:
+            lengths = [batching.sequence_lengths(d) for d in full_data]
 
         for e in range(epochs):
-            zipped = list(zip(*full_data))
-            if self._do_shuffle:
-                np.random.shuffle(zipped)
-            shuffled = list(zip(*zipped))
-
-            for i in range(batch_per_epoch):
-                idx_start = i * self.batch_size
-                idx_end = (i + 1) * self.batch_size
-
-                mb_data = [d[idx_start: idx_end] for d in shuffled]
-                # arg_name_batch = arg_name[idx_start: idx_end]
-                # arg_desc_batch = arg_desc[idx_start: idx_end]
-                yield e, tuple(mb_data)
+            if bucket:
+                batches = self._bucketed_batches(full_data, lengths, offset, index_only)
+            else:
+                batches = self._shuffled_batches(full_data, offset, index_only)
+            for mb_data in batches:
+                yield e, mb_data
 
-    def get_perplexity(self, all_loss, all_translations, all_batch_sizes):
+    def get_perplexity(self, all_loss, all_batch_sizes, no_words):
         losses = [a*b for a,b in zip(all_loss, all_batch_sizes)]
-        no_words = [1 + len(t[0]) for t in all_translations]
-        return np.exp(np.sum(losses)/np.sum(no_words))
+        return np.exp(np.sum(losses)/no_words)
 
 
     def evaluate_bleu(self, session, data, max_points=10000, max_translations=200):
+        # Only the first max_translations are kept for logging, BLEU and
+        # perplexity are accumulated batch by batch
         all_names = []
         all_references = []
         all_references_tok = []
         all_translations = []
         all_training_loss = []
         all_mbs = []
+        no_words = 0
+        bleu_accumulator = bleu.BleuAccumulator(max_order=4)
 
-        ops = [self.merged_metrics, self.train_loss, self.inference_id]
+        ops = [self.train_loss, self.inference_id]
         restricted_data = tuple([d[:max_points] for d in data])
-        for _, minibatch in self._to_batch(restricted_data):
+        for _, minibatch in self._to_batch(restricted_data, offset=self._split_offset(data)):
             all_mbs.append(len(minibatch[0]))
-            metrics, train_loss, inference_ids = self._feed_fwd(
-                session, minibatch, ops)
+            if self.beam_id is None:
+                train_loss, inference_ids = self._feed_fwd(
+                    session, minibatch, ops)
+            else:
+                train_loss = self._feed_fwd(session, minibatch, self.train_loss)
+                inference_ids = self._feed_fwd(session, minibatch, self.beam_id, 'BEAM')
 
             # Translating quirks:
             #    names: RETURN: 'axis<END>' NOT 'a x i s <END>'
@@ -355,47 +511,78 @@ class BasicRNNModel(abc.ABC):
             #    translations: RETURN: ['this', 'translation']
             #                  NOT: ['this', 'translation', '<END>']
             arg_name, arg_desc, arg_desc_translate = minibatch[0], minibatch[1], minibatch[-1]
-            names = [self.translate(i, lookup=self.idx2char).replace(
-                " ", "") for i in arg_name]
+            names = ["".join(n).replace(" ", "") for n in detokenize(arg_name, self.idx2char_array)]
 
             references = [[t] for t in arg_desc_translate]
-            references_tokenized = [[self.translate(i, do_join=False)[1:-1]] for i in arg_desc]
-            translations = [self.translate(
-                i, do_join=False, prepend_tok=self.word2idx[START_OF_TEXT_TOKEN])[1:-1] for i in inference_ids]
-
+            references_tokenized = [[r] for r in detokenize(arg_desc, self.idx2word_array, 1, 1)]
+            translations = detokenize(inference_ids, self.idx2word_array, 0, 1)
 
-            for t in all_translations:
+            # Empty translations are scored (and logged) as "<NOTRANSLATION>"
+            for t in translations:
                 if t == []:
                     LOGGER.warning("EMPTY TRANSLATION")
                     t.append("<NOTRANSLATION>")
+            bleu_accumulator.update(references, translations)
 
             all_training_loss.append(train_loss)
-            all_names.extend(names)
-            all_references.extend(references)
-            all_references_tok.extend(references_tokenized)
-            all_translations.extend(translations)
+            no_words += sum(1 + len(t) for t in arg_desc_translate)
+            keep = max(max_translations - len(all_names), 0)
+            all_names.extend(names[:keep])
+            all_references.extend(references[:keep])
+            all_references_tok.extend(references_tokenized[:keep])
+            all_translations.extend(translations[:keep])
 
         # BLEU TUPLE = (bleu_score, precisions, bp, ratio, translation_length, reference_length)
         # To Do: Replace with NLTK:
         #         smoother = SmoothingFunction()
         #         bleu_score = corpus_bleu(all_references, all_translations,
         #                                  smoothing_function=smoother.method2)
-        bleu_tuple = bleu.compute_bleu(
-            all_references, all_translations, max_order=4, smooth=False)
+        bleu_tuple = bleu_accumulator.result(smooth=False)
         av_loss = np.mean(all_training_loss)
-        perplexity = self.get_perplexity(all_training_loss, all_references, all_mbs)
+        perplexity = self.get_perplexity(all_training_loss, all_mbs, no_words)
         translations = self.build_translations(all_names, all_references, all_references_tok, all_translations, restricted_data)
         return bleu_tuple, av_loss, perplexity,  translations[:max_translations]
 
-    def main(self, session, epochs, data_tuple,  log_dir, filewriters, test_check=20, test_translate=0, initial_step=0):
+    def _evaluate_splits(self, session, data_tuple, e, i, filewriters, eval_points):
+        '''Evaluate on the first eval_points (train, valid, test) examples of each
+        split and log the results. Returns the validation evaluation.'''
+        evaluation_tuples = []
+        for split, max_points in zip(["train", "valid", "test"], eval_points):
+            evaluation_tuple = self.evaluate_bleu(
+                session, getattr(data_tuple, split), max_points=max_points)
+            log_util.log_tensorboard(
+                filewriters[split], i, *evaluation_tuple)
+            evaluation_tuples.append(evaluation_tuple)
+
+        log_util.log_std_out(e, i, *evaluation_tuples)
+        return evaluation_tuples[1]
+
+    @staticmethod
+    def _backup_best(log_dir, best, valid_evaluation_tuple, checkpoint):
+        '''Keep a copy of the checkpoint for every validation metric it improves
+        on. checkpoint() returns the checkpoint path, saving it if needed.'''
+        metrics = [('best_cross_ent', valid_evaluation_tuple[1], -1),
+                   ('best_bleu', valid_evaluation_tuple[0][0], 1),
+                   ('best_perp', valid_evaluation_tuple[2], -1)]
+        for name, value, sign in metrics:
+            if sign * value > sign * best[name]:
+                best[name] = value
+                saveload.backup_for_later(log_dir, checkpoint(), name)
+
+    def main(self, session, epochs, data_tuple,  log_dir, filewriters, test_check=20, test_translate=0, initial_step=0,
+             eval_every=1, eval_points=(5000, 10000, 10000)):
+        '''Train for epochs, evaluating every eval_every epochs. With eval_every=0
+        a checkpoint is saved every epoch instead, for evaluate_checkpoints to
+        pick up in another process.'''
         LOGGER.debug("Starting Main...")
-        min_valid_cross_ent = 1e8
-        max_bleu = 0
-        min_perplexity = 1e8
+        best = dict(INITIAL_BEST)
         epoch = 0
         try:
-            recent_losses = [1e8] * 50  # should use a queue
-            for i, (e, minibatch) in enumerate(self._to_batch(data_tuple.train, epochs)):
+            batches = self._to_batch(data_tuple.train, epochs, sampler=self.batch_sampler, index_only=True)
+            if self.prefetch_depth > 0:
+                batches = batching.prefetch(batches, self.prefetch_depth)
+            batches = batching.instrumented(batches, LOGGER.info, "({} batches)".format(self.batch_sampler))
+            for i, (e, minibatch) in enumerate(batches):
                 i = i + initial_step
 
                 ops = [self.update, self.train_loss,
@@ -406,83 +593,109 @@ class BasicRNNModel(abc.ABC):
 
                 if epoch != e:
                     epoch = e
-                    evaluation_tuple = self.evaluate_bleu(
-                        session, data_tuple.train, max_points=5000)
-                    log_util.log_tensorboard(
-                        filewriters['train'], i, *evaluation_tuple)
-
-                    valid_evaluation_tuple = self.evaluate_bleu(
-                        session, data_tuple.valid, max_points=10000)
-                    log_util.log_tensorboard(
-                        filewriters['valid'], i, *valid_evaluation_tuple)
-
-                    test_evaluation_tuple = self.evaluate_bleu(
-                        session, data_tuple.test, max_points=10000)
-                    log_util.log_tensorboard(
-                        filewriters['test'], i, *test_evaluation_tuple)
-
-                    log_util.log_std_out(
-                        e, i, evaluation_tuple, valid_evaluation_tuple, test_evaluation_tuple)
-
-                    if e % 10 == 0 and e > 0:
-                        model = saveload.save(session, log_dir, self.name, i)
-
-                    not_saved = (e % 10 != 0 )
-                    if valid_evaluation_tuple[1] < min_valid_cross_ent:
-                        min_valid_cross_ent = min(min_valid_cross_ent, valid_evaluation_tuple[1])
-                        if not_saved:
-                            model = saveload.save(session, log_dir, self.name, i)
-                            not_saved = False
-                        saveload.backup_for_later(log_dir, model, 'best_cross_ent')
-
-                    if valid_evaluation_tuple[0][0] > max_bleu:
-                        max_bleu = max(max_bleu, valid_evaluation_tuple[0][0])
-                        if not_saved:
-                            model = saveload.save(session, log_dir, self.name, i)
-                            not_saved = False
-                        saveload.backup_for_later(log_dir, model, 'best_bleu')
-
-                    if valid_evaluation_tuple[2] < min_perplexity:
-                        min_perplexity = min(min_perplexity, valid_evaluation_tuple[2])
-                        if not_saved:
-                            model = saveload.save(session, log_dir, self.name, i)
-                            not_saved = False
-                        saveload.backup_for_later(log_dir, model, 'best_perp')
-
-
-
-
-
-
-                    recent_losses.append(valid_evaluation_tuple[-2])
-                    # if np.argmin(recent_losses) == 0:
-                    #     return
-                    # else:
-                    #     recent_losses.pop(0)
+                    saved = {}
+                    def checkpoint():
+                        if 'model' not in saved:
+                            saved['model'] = saveload.save(session, log_dir, self.name, i)
+                        return saved['model']
+
+                    if (e % 10 == 0 and e > 0) or eval_every <= 0:
+                        checkpoint()
+
+                    if eval_every > 0 and e % eval_every == 0:
+                        valid_evaluation_tuple = self._evaluate_splits(
+                            session, data_tuple, e, i, filewriters, eval_points)
+                        self._backup_best(log_dir, best, valid_evaluation_tuple, checkpoint)
             saveload.save(session, log_dir, self.name, i)
 
         except KeyboardInterrupt as e:
             saveload.save(session, log_dir, self.name, i)
 
+    def evaluate_checkpoints(self, session, data_tuple, log_dir, filewriters,
+                             eval_points=(5000, 10000, 10000), poll_secs=60):
+        '''Evaluate every new checkpoint a training run saves in log_dir (run with
+        --eval-every 0), keeping the best_* backups as main does. Runs until
+        interrupted.'''
+        LOGGER.debug("Watching {} for checkpoints...".format(log_dir))
+        best = dict(INITIAL_BEST)
+        last_step = None
+        batches_per_epoch = -(-len(data_tuple.train[0]) // self.batch_size)
+        try:
+            while True:
+                try:
+                    model, step = saveload.get_latest_checkpoint(log_dir)
+                    step = int(step)
+                except IndexError:
+                    model, step = None, last_step
+                if step != last_step:
+                    checkpoint = "{}/{}.ckpt-{}".format(log_dir, model, step)
+                    # The trainer's Saver may delete the checkpoint at any time:
+                    # evaluate (and back up) a snapshot of it instead
+                    try:
+                        snapshot = saveload.snapshot_checkpoint(checkpoint, "{}/{}".format(log_dir, EVAL_SNAPSHOT_DIR))
+                        saveload.restore(session, snapshot)
+                    except (FileNotFoundError, tf.errors.NotFoundError):
+                        LOGGER.warning("{} was rotated out before it was evaluated, moving on to the latest".format(
+                            checkpoint))
+                        time.sleep(1)
+                        continue
+                    LOGGER.warning("Evaluating {}".format(checkpoint))
+
+                    valid_evaluation_tuple = self._evaluate_splits(
+                        session, data_tuple, step // batches_per_epoch, step, filewriters, eval_points)
+                    self._backup_best(log_dir, best, valid_evaluation_tuple, lambda: snapshot)
+                    last_step = step
+                time.sleep(poll_secs)
+        except KeyboardInterrupt:
+            pass
+
+
+def train_max_decode_len(data_tuple):
+    '''The longest train description (after <START>, up to and including <END>)'''
+    return int(batching.sequence_lengths(data_tuple.train[1]).max()) - 1
+
+
+def model_class_path(Model):
+    '''"module.ClassName" of a model class, importable even when the model
+    was run as a script with python -m.'''
+    module = Model.__module__
+    if module == "__main__":
+        spec = getattr(sys.modules["__main__"], "__spec__", None)
+        if spec is not None:
+            module = spec.name
+    return "{}.{}".format(module, Model.__name__)
+
 
 def _run_model(Model, **kwargs):
     mode = kwargs.pop("mode")
     kwargs["bidirectional"] =  kwargs.get("bidirectional", 0) > 0
 
     if mode == "TRAIN":
+        if kwargs.get("eval_every", 1) <= 0 and kwargs["save_every"] <= 0:
+            # Nothing would be evaluated: the EVAL process only sees saved checkpoints
+            raise ValueError("--eval-every 0 needs checkpoints to be saved, set --save-every > 0")
         log_path = log_util.to_log_path(kwargs["logdir"], kwargs["name"])
         log_util.setup_logger(log_path)
 
         kwargs['git'] = saveload.get_githash()
-        saveload.save_args(log_path, kwargs)
+        kwargs['model_class'] = model_class_path(Model)
     else:
         log_path = kwargs["logdir"]
         LOGGER.warning('LOADING FROM: {}, overwriting kwargs'.format(log_path))
+        eval_kwargs = {k: kwargs[k] for k in EVAL_ARGS if k in kwargs}
         kwargs = saveload.load_args(log_path)
+        if mode == "EVAL":
+            # The evaluator's own settings, not the training run's
+            kwargs.update(eval_kwargs)
         log_util.setup_logger(log_path)
 
     LOGGER.info(" ".join(sys.argv))
     embed_tuple, data_tuple = get_embed_tuple_and_data_tuple(**kwargs)
+    if not kwargs.get("max_decode_len"):
+        kwargs["max_decode_len"] = train_max_decode_len(data_tuple)
+    if mode == "TRAIN":
+        saveload.save_args(log_path, kwargs)
+
     nn = Model(embed_tuple, **kwargs)
 
     summary = ArgumentSummary(nn, kwargs)
@@ -501,17 +714,25 @@ def _run_model(Model, **kwargs):
 
     filewriters = log_util.get_filewriters(log_path, sess)
 
-    if mode == "TRAIN":
+    if mode in ["TRAIN", "EVAL"]:
+        # (the evaluator restores each checkpoint as it is saved)
         sess.run(init)
         step = 0
     else:
         _, step = saveload.load(sess, log_path)
         LOGGER.warning("Loaded from {}: Global Step {}".format(log_path, step))
 
+    if nn.input_mode == "graph":
+        nn.load_graph_data(sess, data_tuple)
+
+    eval_points = kwargs.get("eval_points", (5000, 10000, 10000))
     if mode in ["TRAIN", "LOAD"]:
         nn.main(sess, kwargs["epochs"], data_tuple, log_path, filewriters,
             test_check=kwargs["test_freq"], test_translate=kwargs["test_translate"],
-            initial_step=step)
+            initial_step=step, eval_every=kwargs.get("eval_every", 1), eval_points=eval_points)
+    elif mode == "EVAL":
+        nn.evaluate_checkpoints(sess, data_tuple, log_path, filewriters,
+                                eval_points=eval_points, poll_secs=kwargs.get("eval_poll_secs", 60))
     elif mode == "RETURN":
         return sess, nn, data_tuple, step
     else:
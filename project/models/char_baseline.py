@@ -17,8 +17,8 @@ LOGGER = logging.getLogger('')
 class CharSeqBaseline(BasicRNNModel):
 
     def __init__(self, embed_tuple, lstm_size, batch_size, learning_rate,
-                dropout, bidirectional, use_attention,  model_name="BasicModel", **_):
-        super().__init__(embed_tuple, model_name)
+                dropout, bidirectional, use_attention,  model_name="BasicModel", **kwargs):
+        super().__init__(embed_tuple, model_name, **kwargs)
         # To Do; all these args from config, to make saving model easier.
 
         self.batch_size = batch_size
@@ -65,11 +65,11 @@ class CharSeqBaseline(BasicRNNModel):
         with tf.name_scope("Model_{}".format(self.name)):
             # 0. Define our placeholders and derived vars
             # # input_data_sequence : [batch_size x max_variable_length]
-            input_data_sequence = tf.placeholder(tf.int32, [None, None], "arg_name")
+            input_data_sequence = self._input_tensor(0, "arg_name")
             input_data_seq_length = tf.argmin(
                 input_data_sequence, axis=1, output_type=tf.int32)
             # # input_label_sequence  : [batch_size x max_docstring_length]
-            input_label_sequence = tf.placeholder(tf.int32, [None, None], "arg_desc")
+            input_label_sequence = self._input_tensor(1, "arg_desc")
             input_label_seq_length = tf.argmin(
                 input_label_sequence, axis=1, output_type=tf.int32)
             dropout_keep_prob = tf.placeholder_with_default(1.0, shape=())
@@ -103,8 +103,8 @@ class CharSeqBaseline(BasicRNNModel):
                 desc_vocab_size, use_bias=False)
 
             attention_mechanism = tf.contrib.seq2seq.LuongAttention(
-                decode_rnn_size, encoder_outputs,
-                memory_sequence_length=input_data_seq_length)
+                decode_rnn_size, self._beam_tiled(encoder_outputs),
+                memory_sequence_length=self._beam_tiled(input_data_seq_length))
 
             decoder_rnn_cell = tf.contrib.rnn.DropoutWrapper(
                 decoder_rnn_cell,
@@ -131,7 +131,13 @@ class CharSeqBaseline(BasicRNNModel):
                                                                          self.word2idx[START_OF_TEXT_TOKEN],
                                                                          self.word2idx[END_OF_TEXT_TOKEN],
                                                                          self.use_attention,
-                                                                         )
+                                                                         maximum_iterations=self.max_decode_len)
+
+            beam_id = self._build_rnn_beam_search_decoder(decoder_rnn_cell,
+                                                          state, projection_layer, decoder_weights,
+                                                          self.word2idx[START_OF_TEXT_TOKEN],
+                                                          self.word2idx[END_OF_TEXT_TOKEN],
+                                                          self.use_attention)
 
             # 5. Define Train Loss
             train_logits = train_outputs.rnn_output
@@ -146,7 +152,7 @@ class CharSeqBaseline(BasicRNNModel):
                 inf_logits, input_label_sequence, input_label_seq_length)
 
             # 7. Do Updates
-            update = self._do_updates(train_loss, self.learning_rate)
+            update = None if self.inference_only else self._do_updates(train_loss, self.learning_rate)
 
             # 8. Save Variables to Model
             self.input_data_sequence = input_data_sequence
@@ -158,6 +164,7 @@ class CharSeqBaseline(BasicRNNModel):
 
             self.inference_loss = inf_loss
             self.inference_id = inf_translate
+            self.beam_id = beam_id
             self.inf_state = inf_state
             self.inf_outputs = inf_outputs
 
@@ -23,8 +23,8 @@ SingleTranslationWithPaths.__str__ = lambda s: "ARGN: {}\nCODE: {}\nDESC: {}\nTO
 class Code2VecEncoder(BasicRNNModel):
 
     def __init__(self, embed_tuple, lstm_size, batch_size, learning_rate,
-                dropout, bidirectional, vec_size, path_seq, path_vocab, path_embed, model_name="BasicModel", **_):
-        super().__init__(embed_tuple, model_name)
+                dropout, bidirectional, vec_size, path_seq, path_vocab, path_embed, model_name="BasicModel", **kwargs):
+        super().__init__(embed_tuple, model_name, **kwargs)
         # To Do; all these args from config, to make saving model easier.
 
         self.batch_size = batch_size
@@ -73,7 +73,9 @@ class Code2VecEncoder(BasicRNNModel):
         return tf.summary.merge_all()
 
     def build_translations(self, all_names, all_references, all_references_tok, all_translations, all_data):
-        get_path_stats = lambda x: "Paths: {}/{},  Of Which <UNK> {}".format(np.count_nonzero(x), len(x), (x==1).sum())
+        # Out of the padded width (path_seq + 1), as when paths were stored dense
+        get_path_stats = lambda x: "Paths: {}/{},  Of Which <UNK> {}".format(
+            np.count_nonzero(x), self.path_seq + 1, (x==1).sum())
         return [SingleTranslationWithPaths(n, r[0], t[0], tr, get_path_stats(s)) for n, r, t, tr, s in zip(
             all_names, all_references, all_references_tok, all_translations, all_data[2])]
 
@@ -169,12 +171,12 @@ class Code2VecEncoder(BasicRNNModel):
         with tf.name_scope("Model_{}".format(self.name)):
             # 0. Define our placeholders and derived vars
             # # input_data_sequence : [batch_size x max_variable_length]
-            input_data_sequence = tf.placeholder(tf.int32, [None, None], "arg_name")
+            input_data_sequence = self._input_tensor(0, "arg_name")
             input_data_seq_length = tf.argmin(
                 input_data_sequence, axis=1, output_type=tf.int32)
 
             # # input_label_sequence  : [batch_size x max_docstring_length]
-            input_label_sequence = tf.placeholder(tf.int32, [None, None], "arg_desc")
+            input_label_sequence = self._input_tensor(1, "arg_desc")
             input_label_seq_length = tf.argmin(
                 input_label_sequence, axis=1, output_type=tf.int32)
             dropout_keep_prob = tf.placeholder_with_default(1.0, shape=())
@@ -182,8 +184,8 @@ class Code2VecEncoder(BasicRNNModel):
             # CODE 2 VEC
             # # input_codepaths : [batch_size x max_codepaths]
             # # input_target_vars : [batch_size x max_codepaths]
-            input_codepaths = tf.placeholder(tf.int32, [None, None], "paths")
-            input_target_vars = tf.placeholder(tf.int32, [None, None], "paths")
+            input_codepaths = self._input_tensor(2, "paths", ragged=True)
+            input_target_vars = self._input_tensor(3, "paths", ragged=True)
             input_codepaths_seq_length = tf.argmin(
                  input_codepaths, axis=1, output_type=tf.int32)
 
@@ -233,8 +235,8 @@ class Code2VecEncoder(BasicRNNModel):
                 desc_vocab_size, use_bias=False)
 
             attention_mechanism1 = tf.contrib.seq2seq.LuongAttention(
-                decoder_rnn_size, first_encoder_outputs,
-                memory_sequence_length=input_data_seq_length,
+                decoder_rnn_size, self._beam_tiled(first_encoder_outputs),
+                memory_sequence_length=self._beam_tiled(input_data_seq_length),
                 name="LuongAttention1")
 
             decoder_rnn_cell = tf.contrib.rnn.DropoutWrapper(
@@ -256,7 +258,13 @@ class Code2VecEncoder(BasicRNNModel):
             inf_outputs, _, _ = self._build_rnn_greedy_inference_decoder(decoder_rnn_cell,
                                                                          state, projection_layer, decoder_weights,
                                                                          self.word2idx[START_OF_TEXT_TOKEN],
-                                                                         self.word2idx[END_OF_TEXT_TOKEN])
+                                                                         self.word2idx[END_OF_TEXT_TOKEN],
+                                                                         maximum_iterations=self.max_decode_len)
+
+            beam_id = self._build_rnn_beam_search_decoder(decoder_rnn_cell,
+                                                          state, projection_layer, decoder_weights,
+                                                          self.word2idx[START_OF_TEXT_TOKEN],
+                                                          self.word2idx[END_OF_TEXT_TOKEN])
 
             # 5. Define Train Loss
             train_logits = train_outputs.rnn_output
@@ -271,7 +279,7 @@ class Code2VecEncoder(BasicRNNModel):
                 inf_logits, input_label_sequence, input_label_seq_length)
 
             # 7. Do Updates
-            update = self._do_updates(train_loss, self.learning_rate)
+            update = None if self.inference_only else self._do_updates(train_loss, self.learning_rate)
 
             # 8. Save Variables to Model
             self.input_data_sequence = input_data_sequence
@@ -288,31 +296,9 @@ class Code2VecEncoder(BasicRNNModel):
 
             self.inference_loss = inf_loss
             self.inference_id = inf_translate
+            self.beam_id = beam_id
 
 
-    def _feed_fwd(self, session, minibatch, operation, mode=None):
-        """
-        Evaluates a node in the graph
-        Args
-            session: session that is being run
-            input_data, array: batch of comments
-            input_labels, array: batch of labels
-            operation: node in graph to be evaluated
-        Returns
-            output of the operation
-        """
-        input_data, input_labels, input_paths, input_target_vars  = minibatch[0], minibatch[1], minibatch[2], minibatch[3]
-        run_ouputs = operation
-        feed_dict = {self.input_data_sequence: input_data,
-                     self.input_label_sequence: input_labels,
-                     self.input_codepaths: input_paths,
-                     self.input_target_vars: input_target_vars,
-                      }
-        if mode == 'TRAIN':
-            feed_dict[self.dropout_keep_prob] = 1 - self.dropout
-
-        return session.run(run_ouputs, feed_dict=feed_dict)
-
 def run_model(**kwargs):
     _run_model(Code2VecEncoder, **kwargs)
 
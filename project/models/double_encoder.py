@@ -23,8 +23,8 @@ SingleTranslationWithCode.__str__ = lambda s: "ARGN: {}\nCODE: {}\nDESC: {}\nTOK
 class DoubleEncoderBaseline(BasicRNNModel):
 
     def __init__(self, embed_tuple, rnn_size=300, batch_size=128, learning_rate=0.001,
-                dropout=0.3, bidirectional=False, model_name="BasicModel", **_):
-        super().__init__(embed_tuple, model_name)
+                dropout=0.3, bidirectional=False, model_name="BasicModel", **kwargs):
+        super().__init__(embed_tuple, model_name, **kwargs)
         # To Do; all these args from config, to make saving model easier.
 
         self.batch_size = batch_size
@@ -106,15 +106,15 @@ class DoubleEncoderBaseline(BasicRNNModel):
         with tf.name_scope("Model_{}".format(self.name)):
             # 0. Define our placeholders and derived vars
             # # input_data_sequence : [batch_size x max_variable_length]
-            input_data_sequence = tf.placeholder(tf.int32, [None, None], "arg_name")
+            input_data_sequence = self._input_tensor(0, "arg_name")
             input_data_seq_length = tf.argmin(
                 input_data_sequence, axis=1, output_type=tf.int32) + 1
             # # second_data_sequence : [batch_size x max_variable_length]
-            second_data_sequence = tf.placeholder(tf.int32, [None, None], "code_seq")
+            second_data_sequence = self._input_tensor(2, "code_seq")
             second_data_seq_length = tf.argmin(
                 second_data_sequence, axis=1, output_type=tf.int32) + 1
             # # input_label_sequence  : [batch_size x max_docstring_length]
-            input_label_sequence = tf.placeholder(tf.int32, [None, None], "arg_desc")
+            input_label_sequence = self._input_tensor(1, "arg_desc")
             input_label_seq_length = tf.argmin(
                 input_label_sequence, axis=1, output_type=tf.int32) + 1
             dropout_keep_prob = tf.placeholder_with_default(1.0, shape=())
@@ -159,8 +159,8 @@ class DoubleEncoderBaseline(BasicRNNModel):
 
 
             attention_mechanism1 = tf.contrib.seq2seq.LuongAttention(
-                decoder_rnn_size, first_encoder_outputs,
-                memory_sequence_length=input_data_seq_length,
+                decoder_rnn_size, self._beam_tiled(first_encoder_outputs),
+                memory_sequence_length=self._beam_tiled(input_data_seq_length),
                 name="LuongAttention1")
 
             decoder_rnn_cell = tf.contrib.rnn.DropoutWrapper(
@@ -183,7 +183,13 @@ class DoubleEncoderBaseline(BasicRNNModel):
             inf_outputs, _, _ = self._build_rnn_greedy_inference_decoder(decoder_rnn_cell,
                                                                          state, projection_layer, decoder_weights,
                                                                          self.word2idx[START_OF_TEXT_TOKEN],
-                                                                         self.word2idx[END_OF_TEXT_TOKEN])
+                                                                         self.word2idx[END_OF_TEXT_TOKEN],
+                                                                         maximum_iterations=self.max_decode_len)
+
+            beam_id = self._build_rnn_beam_search_decoder(decoder_rnn_cell,
+                                                          state, projection_layer, decoder_weights,
+                                                          self.word2idx[START_OF_TEXT_TOKEN],
+                                                          self.word2idx[END_OF_TEXT_TOKEN])
 
             # 6. Define Train Loss
             train_logits = train_outputs.rnn_output
@@ -198,7 +204,7 @@ class DoubleEncoderBaseline(BasicRNNModel):
                 inf_logits, input_label_sequence, input_label_seq_length)
 
             # 8. Do Updates
-            update = self._do_updates(train_loss, self.learning_rate)
+            update = None if self.inference_only else self._do_updates(train_loss, self.learning_rate)
 
             # 9. Save Variables to Model
             self.input_data_sequence = input_data_sequence
@@ -211,27 +217,8 @@ class DoubleEncoderBaseline(BasicRNNModel):
 
             self.inference_loss = inf_loss
             self.inference_id = inf_translate
+            self.beam_id = beam_id
 
-    def _feed_fwd(self, session, minibatch, operation, mode=None):
-        """
-        Evaluates a node in the graph
-        Args
-            session: session that is being run
-            input_data, array: batch of comments
-            input_labels, array: batch of labels
-            operation: node in graph to be evaluated
-        Returns
-            output of the operation
-        """
-        input_data, input_labels, input_code = minibatch[0], minibatch[1], minibatch[2]
-        run_ouputs = operation
-        feed_dict = {self.input_data_sequence: input_data,
-                     self.input_label_sequence: input_labels,
-                     self.second_data_sequence: input_code }
-        if mode == 'TRAIN':
-            feed_dict[self.dropout_keep_prob] = 1 - self.dropout
-
-        return session.run(run_ouputs, feed_dict=feed_dict)
 
 def run_model(**kwargs):
     kwargs['code_tokenizer'] = 'full'
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+'''Export a trained run for inference.
+
+    python -m project.models.export -L logs/my_run
+
+writes <log dir>/export/: the frozen inference graph (inference.pb) and a
+pickle of everything needed to tokenize requests (args, word2idx, char2idx,
+the code2vec path and target var vocabularies and the src vocabulary).
+load_export restores a ready to decode model from these alone, without
+loading the dataset or GloVe.
+'''
+import argparse
+import logging
+import os
+import pickle
+import sys
+
+import tensorflow as tf
+
+from project.models.serve import Featurizer, load_model
+from project.utils import tokenize
+from project.utils.tokenize import lookup_array, detokenize
+
+LOGGER = logging.getLogger('')
+
+EXPORT_DIR = "export"
+GRAPH_FILE = "inference.pb"
+VOCAB_FILE = "vocab.pkl"
+
+
+def export_dir(log_path):
+    return "{}/{}".format(log_path, EXPORT_DIR)
+
+
+def _node_name(tensor):
+    return tensor.name.split(":")[0]
+
+
+def export_model(log_path, model_class=None, beam_width=None):
+    '''Freeze the inference graph of the latest checkpoint in log_path and
+    save it with its vocabularies. Decodes with beam search if beam_width
+    (by default as trained) is more than 1.'''
+    sess, nn, featurizer = load_model(log_path, model_class, beam_width)
+    output = nn.inference_id if nn.beam_id is None else nn.beam_id
+
+    graph_def = tf.graph_util.convert_variables_to_constants(
+        sess, sess.graph.as_graph_def(), [_node_name(output)])
+
+    out_dir = export_dir(log_path)
+    if not os.path.exists(out_dir):
+        os.mkdir(out_dir)
+    with open("{}/{}".format(out_dir, GRAPH_FILE), 'wb') as f:
+        f.write(graph_def.SerializeToString())
+
+    manifest = {
+        'kwargs': featurizer.kwargs,
+        'word2idx': featurizer.word2idx,
+        'char2idx': featurizer.char2idx,
+        'path2idx': featurizer.path2idx,
+        'tv2idx': featurizer.tv2idx,
+        'src_vocab': tokenize.SRC_VOCAB,
+        'inputs': [(column, t.name) for column, t in nn.input_tensors],
+        'output': output.name,
+        'beam_multiplier': nn.beam_multiplier.name if nn.beam_multiplier is not None else None,
+        'beam_width': nn.beam_width,
+    }
+    with open("{}/{}".format(out_dir, VOCAB_FILE), 'wb') as f:
+        pickle.dump(manifest, f)
+
+    LOGGER.warning("Exported {} nodes to {}".format(len(graph_def.node), out_dir))
+    sess.close()
+    return out_dir
+
+
+def has_export(log_path):
+    return os.path.isfile("{}/{}".format(export_dir(log_path), GRAPH_FILE))
+
+
+class ExportedModel(object):
+    '''A frozen inference graph with the vocabularies it was trained with.'''
+
+    def __init__(self, log_path):
+        in_dir = export_dir(log_path)
+        with open("{}/{}".format(in_dir, VOCAB_FILE), 'rb') as f:
+            manifest = pickle.load(f)
+
+        if manifest['src_vocab'] is not None:
+            tokenize.SRC_VOCAB = manifest['src_vocab']
+        self.featurizer = Featurizer(manifest['kwargs'], manifest['word2idx'], manifest['char2idx'],
+                                     manifest['path2idx'], manifest['tv2idx'])
+        self.idx2word_array = lookup_array({v: k for k, v in manifest['word2idx'].items()})
+
+        graph_def = tf.GraphDef()
+        with open("{}/{}".format(in_dir, GRAPH_FILE), 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+        self.session = tf.Session(graph=self.graph)
+
+        # Inputs the frozen graph does not depend on were pruned
+        names = set(n.name for n in graph_def.node)
+        self.inputs = [(column, self.graph.get_tensor_by_name(name))
+                       for column, name in manifest['inputs'] if name.split(":")[0] in names]
+        self.output = self.graph.get_tensor_by_name(manifest['output'])
+        self.beam_multiplier = None
+        if manifest['beam_multiplier'] is not None:
+            self.beam_multiplier = self.graph.get_tensor_by_name(manifest['beam_multiplier'])
+        self.beam_width = manifest['beam_width']
+
+    def decode(self, minibatch):
+        '''[batch_size x time] description ids for a Featurizer minibatch.'''
+        feed_dict = {t: minibatch[c] for c, t in self.inputs}
+        if self.beam_multiplier is not None:
+            feed_dict[self.beam_multiplier] = self.beam_width
+        return self.session.run(self.output, feed_dict=feed_dict)
+
+    def describe(self, minibatch):
+        return [" ".join(t) for t in detokenize(self.decode(minibatch), self.idx2word_array, 0, 1)]
+
+
+def load_export(log_path):
+    return ExportedModel(log_path)
+
+
+def _build_argparser():
+    parser = argparse.ArgumentParser(description='Export a trained model for inference')
+    parser.add_argument('--logdir', '-L', dest='logdir', action='store', required=True,
+                        help='log dir of the trained run (with args.pkl and checkpoints)')
+    parser.add_argument('--model', '-m', dest='model_class', action='store', default=None,
+                        help='model module or class path, for runs that did not save it')
+    parser.add_argument('--beam-width', '-bw', dest='beam_width', action='store', type=int, default=None,
+                        help='beam width to export (by default as the model was trained)')
+    return parser
+
+
+if __name__ == "__main__":
+    opts = _build_argparser().parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    export_model(opts.logdir, opts.model_class, opts.beam_width)
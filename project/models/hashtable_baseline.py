@@ -159,11 +159,15 @@ class HashtableBaseline(object):
                             self.codepath_lookup_list_soft[j][n].append(i)
 
 
-    def evaluate(self, all_translations):
+    def evaluate(self, all_translations, reference_ngrams=None):
         references = [[t.description] for t in all_translations]
         translations = [t.translation for t in all_translations]
 
-        return bleu.compute_bleu(references, translations, max_order=4, smooth=False)
+        # reference_ngrams (from bleu.get_reference_ngrams) saves recounting
+        # the same references on every run
+        accumulator = bleu.BleuAccumulator(max_order=4)
+        accumulator.update(references, translations, reference_ngrams)
+        return accumulator.result(smooth=False)
 
     def main(self, train_data, test_data):
         self.train(train_data)
@@ -222,6 +226,9 @@ def _run_model(**kwargs):
 
 
 
+    valid_ngrams = bleu.get_reference_ngrams([[d["arg_desc_translate"]] for d in valid_data], max_order=4)
+    test_ngrams = bleu.get_reference_ngrams([[d["arg_desc_translate"]] for d in test_data], max_order=4)
+
     all_results = []
     for mode in kwargs['code_mode']:
         model = HashtableBaseline(mode, idx2path, idx2tv)
@@ -234,8 +241,8 @@ def _run_model(**kwargs):
         for i in range(kwargs['n_times']):
             random.seed(i)
 
-            bleu = model.evaluate(model.test(valid_data))[0]*100
-            bleu_test = model.evaluate(model.test(test_data))[0]*100
+            bleu = model.evaluate(model.test(valid_data), valid_ngrams)[0]*100
+            bleu_test = model.evaluate(model.test(test_data), test_ngrams)[0]*100
             LOG(bleu)
             results.append(bleu)
             test_results.append(bleu_test)
@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+'''Serve descriptions from a trained model.
+
+Loads the export of a log dir (see project.models.export), or else args.pkl
+and the latest checkpoint, building the model for inference only, and
+answers requests (function source + argument name) either over HTTP:
+
+    python -m project.models.serve -L logs/my_run --port 8000
+    curl -d '{"src": "def f(axis):\\n    return axis", "arg_name": "axis"}' localhost:8000
+
+or as JSON lines on stdin/stdout (without --port). Concurrent requests are
+decoded together in minibatches of up to --max-batch, waiting at most
+--max-latency ms for a batch to fill up.
+'''
+import argparse
+import ast
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import importlib
+import json
+import logging
+import queue
+from socketserver import ThreadingMixIn
+import sys
+import threading
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from project.models.base_model import train_max_decode_len
+from project.utils import batching
+import project.utils.saveload as saveload
+from project.utils.code_tokenize import clear_leading_indent, extract_codepath_strings, index_codepaths
+from project.utils.tokenize import get_embed_tuple_and_data_tuple, get_code2vec_vocab, get_model_fields, \
+                         choose_name_tokenizer, choose_code_tokenizer, extract_tensors, detokenize, \
+                         START_OF_TEXT_TOKEN, END_OF_TEXT_TOKEN
+
+LOGGER = logging.getLogger('')
+
+# Models trained before model_class was saved with their args
+MODELS = {
+    'char_baseline': 'project.models.char_baseline.CharSeqBaseline',
+    'code2vec_encoder': 'project.models.code2vec_encoder.Code2VecEncoder',
+    'code2vec_solo': 'project.models.code2vec_solo.Code2VecSolo',
+    'double_encoder': 'project.models.double_encoder.DoubleEncoderBaseline',
+}
+
+CODEPATH_FIELDS = ["path_idx", "target_var_idx", "target_var_mask_idx", "target_var_mask_names"]
+
+
+def import_model_class(path):
+    path = MODELS.get(path, path)
+    module, name = path.rsplit(".", 1)
+    return getattr(importlib.import_module(module), name)
+
+
+class Featurizer(object):
+    '''Turns (src, arg_name) requests into minibatches for a model trained
+    with kwargs, tokenized as its training data was.'''
+
+    def __init__(self, kwargs, word2idx, char2idx, path2idx=None, tv2idx=None):
+        self.kwargs = kwargs
+        self.word2idx = word2idx
+        self.char2idx = char2idx
+        self.path2idx = path2idx
+        self.tv2idx = tv2idx
+        self.path_vocab = kwargs.get("path_vocab", 1000)
+
+        self.fill_name = choose_name_tokenizer(kwargs["tokenizer"])
+        self.code_tokenize = choose_code_tokenizer(kwargs["code_tokenizer"])
+        self.fields, self.seq_lengths, self.ragged_fields = get_model_fields(**kwargs)
+
+    def record(self, src, arg_name):
+        '''A tokenized record for arg_name of the (first) function in src.
+        Raises if src does not parse or, for code2vec models, if arg_name has
+        no code paths (such args are not in the training data either).'''
+        tree = ast.parse(clear_leading_indent(src))
+        funcs = [n for n in ast.walk(tree) if isinstance(n, (ast.FunctionDef, ast.AsyncFunctionDef))]
+        if not funcs:
+            raise ValueError("no function definition in src")
+        func_args = funcs[0].args
+        d = {"src": src, "arg_name": arg_name, "arg_desc": "", "name": funcs[0].name,
+             "args": [a.arg for a in func_args.args + func_args.kwonlyargs]}
+
+        if self.path2idx is not None:
+            d["path_strings"], d["target_var_string"] = extract_codepath_strings(d)
+            if not d["path_strings"]:
+                raise ValueError("no code paths from '{}'".format(arg_name))
+            index_codepaths(d, self.path2idx, self.tv2idx)
+            # As stored in the quickload datasets
+            for f in CODEPATH_FIELDS:
+                d[f] = " ".join(str(n).replace(" ", "<SPACE>") for n in d[f])
+
+        self.fill_name(d, self.char2idx)
+        # The decoder starts from <START> on its own, this only fills the column
+        d["arg_desc_idx"] = [self.word2idx[START_OF_TEXT_TOKEN], self.word2idx[END_OF_TEXT_TOKEN]]
+        self.code_tokenize([d], word2idx=self.word2idx, path_vocab=self.path_vocab)
+        return d
+
+    def batch(self, records):
+        '''The minibatch of tokenized records, padded to its longest rows.'''
+        idx = np.arange(len(records))
+        tensors = extract_tensors(records, self.fields, self.seq_lengths, self.ragged_fields)
+        columns = [batching.gather(t, idx, batching.sequence_lengths(t)) for t in tensors]
+        return tuple(columns + [[[] for _ in records]])
+
+
+def load_model(log_path, model_class=None, beam_width=None):
+    '''Rebuild the model trained in log_path for inference only and restore its
+    latest checkpoint. Returns (session, model, featurizer).'''
+    kwargs = saveload.load_args(log_path)
+    Model = import_model_class(model_class or kwargs["model_class"])
+    kwargs.update(input_mode="feed", inference_only=True)
+    if beam_width is not None:
+        kwargs["beam_width"] = beam_width
+
+    embed_tuple, data_tuple = get_embed_tuple_and_data_tuple(**kwargs)
+    if not kwargs.get("max_decode_len"):
+        kwargs["max_decode_len"] = train_max_decode_len(data_tuple)
+
+    path2idx, tv2idx = None, None
+    if "code2vec" in kwargs["code_tokenizer"]:
+        path2idx, tv2idx = get_code2vec_vocab(
+            kwargs["use_full_dataset"], kwargs["use_split_dataset"], kwargs["no_dups"])
+
+    nn = Model(embed_tuple, **kwargs)
+    sess = tf.Session()
+    _, step = saveload.load(sess, log_path)
+    LOGGER.warning("Loaded from {}: Global Step {}".format(log_path, step))
+
+    return sess, nn, Featurizer(kwargs, embed_tuple.word2idx, embed_tuple.char2idx, path2idx, tv2idx)
+
+
+def describe(session, nn, minibatch):
+    '''The decoded description of every example in the minibatch.'''
+    if nn.beam_id is None:
+        ids = nn._feed_fwd(session, minibatch, nn.inference_id)
+    else:
+        ids = nn._feed_fwd(session, minibatch, nn.beam_id, 'BEAM')
+    return [" ".join(t) for t in detokenize(ids, nn.idx2word_array, 0, 1)]
+
+
+class MicroBatcher(object):
+    '''Collects requests from any number of threads into minibatches of up to
+    max_batch, decoded in one background thread. A batch is run once it is
+    full or max_latency seconds after its first request arrived.'''
+
+    def __init__(self, featurizer, run_batch, max_batch=64, max_latency=0.01):
+        self.featurizer = featurizer
+        self.run_batch = run_batch
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def submit(self, src, arg_name):
+        '''A Future of the description of arg_name in src.'''
+        future = Future()
+        self.requests.put(((src, arg_name), future))
+        return future
+
+    def close(self):
+        self.requests.put(None)
+        self.thread.join()
+
+    def _serve(self):
+        while True:
+            first = self.requests.get()
+            if first is None:
+                return
+
+            batch, closing = [first], False
+            deadline = time.time() + self.max_latency
+            while len(batch) < self.max_batch:
+                try:
+                    item = self.requests.get(timeout=max(deadline - time.time(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    closing = True
+                    break
+                batch.append(item)
+
+            self._run(batch)
+            if closing:
+                return
+
+    def _run(self, batch):
+        start = time.time()
+        records, futures = [], []
+        for (src, arg_name), future in batch:
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                records.append(self.featurizer.record(src, arg_name))
+                futures.append(future)
+            except Exception as e:
+                future.set_exception(e)
+
+        if not records:
+            return
+        try:
+            descriptions = self.run_batch(self.featurizer.batch(records))
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            return
+
+        for future, description in zip(futures, descriptions):
+            future.set_result(description)
+        LOGGER.info("Served {} of {} requests in {:.3f}s".format(len(records), len(batch), time.time() - start))
+
+
+def _response(future):
+    try:
+        return {"description": future.result()}
+    except Exception as e:
+        return {"error": "{}: {}".format(type(e).__name__, e)}
+
+
+def _submit(batcher, request):
+    try:
+        return batcher.submit(request["src"], request["arg_name"])
+    except (KeyError, TypeError):
+        future = Future()
+        future.set_exception(ValueError("expected {{\"src\": ..., \"arg_name\": ...}}, got {!r}".format(request)))
+        return future
+
+
+def serve_stdin(batcher, stdin=sys.stdin, stdout=sys.stdout):
+    '''One JSON request per input line, one JSON response per output line, in
+    order. Lines are read ahead so consecutive requests are batched.'''
+    pending = queue.Queue()
+
+    def write():
+        while True:
+            future = pending.get()
+            if future is None:
+                return
+            stdout.write(json.dumps(_response(future)) + "\n")
+            stdout.flush()
+
+    writer = threading.Thread(target=write, daemon=True)
+    writer.start()
+    for line in stdin:
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+        except ValueError:
+            request = None
+        pending.put(_submit(batcher, request))
+    pending.put(None)
+    writer.join()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve_http(batcher, host, port):
+    '''POST a JSON request, or a list of them, to any path. Each handler thread
+    waits for its own results, so concurrent requests share minibatches.'''
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+            except ValueError as e:
+                self.send_error(400, "Invalid JSON: {}".format(e))
+                return
+            requests = body if isinstance(body, list) else [body]
+            responses = [_response(f) for f in [_submit(batcher, r) for r in requests]]
+
+            payload = json.dumps(responses if isinstance(body, list) else responses[0]).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            LOGGER.debug(format % args)
+
+    server = _ThreadingHTTPServer((host, port), Handler)
+    LOGGER.warning("Serving on http://{}:{}".format(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def _build_argparser():
+    parser = argparse.ArgumentParser(description='Serve descriptions from a trained model')
+    parser.add_argument('--logdir', '-L', dest='logdir', action='store', required=True,
+                        help='log dir of the trained run (with args.pkl and checkpoints)')
+    parser.add_argument('--model', '-m', dest='model_class', action='store', default=None,
+                        help='model module ({}) or class path, for runs that did not save it'.format(
+                            ", ".join(sorted(MODELS))))
+    parser.add_argument('--port', '-p', dest='port', action='store', type=int, default=0,
+                        help='serve HTTP on this port (0 for JSON lines on stdin/stdout)')
+    parser.add_argument('--host', dest='host', action='store', default='127.0.0.1',
+                        help='address to serve HTTP on')
+    parser.add_argument('--max-batch', '-b', dest='max_batch', action='store', type=int, default=64,
+                        help='maximum number of requests decoded together')
+    parser.add_argument('--max-latency', '-t', dest='max_latency', action='store', type=float, default=10,
+                        help='maximum ms to wait for more requests before decoding a batch')
+    parser.add_argument('--beam-width', '-bw', dest='beam_width', action='store', type=int, default=None,
+                        help='beam width (by default as the model was trained)')
+    return parser
+
+
+if __name__ == "__main__":
+    opts = _build_argparser().parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+
+    from project.models import export
+    if export.has_export(opts.logdir) and opts.model_class is None and opts.beam_width is None:
+        model = export.load_export(opts.logdir)
+        featurizer, run_batch = model.featurizer, model.describe
+    else:
+        sess, nn, featurizer = load_model(opts.logdir, opts.model_class, opts.beam_width)
+        run_batch = lambda mb: describe(sess, nn, mb)
+
+    batcher = MicroBatcher(featurizer, run_batch,
+                           max_batch=opts.max_batch, max_latency=opts.max_latency / 1000)
+    try:
+        if opts.port:
+            serve_http(batcher, opts.host, opts.port)
+        else:
+            serve_stdin(batcher)
+    finally:
+        batcher.close()
@@ -61,7 +61,25 @@ def log_args(parse_fn):
                        help='how often to save every run')
         p.add_argument('--mode', '-M', dest='mode', action='store',
                        type=str, default="TRAIN",
-                       help='TRAIN, LOAD, RETURN')
+                       help='TRAIN, LOAD, RETURN, or EVAL to evaluate the checkpoints of a run in --logdir as they are saved')
+        p.add_argument('--eval-every', '-ee', dest='eval_every', action='store',
+                       type=int, default=1,
+                       help='epochs between evaluations; 0 to only save a checkpoint every epoch (for a separate EVAL process)')
+        p.add_argument('--eval-points', '-ep', dest='eval_points', action='store',
+                       type=int, nargs=3, default=[5000, 10000, 10000],
+                       help='number of train, valid and test examples to evaluate on')
+        p.add_argument('--eval-poll-secs', '-eq', dest='eval_poll_secs', action='store',
+                       type=int, default=60,
+                       help='how often EVAL mode checks for a new checkpoint')
+        p.add_argument('--beam-width', '-bw', dest='beam_width', action='store',
+                       type=int, default=1,
+                       help='beam width used to decode evaluations (1 for greedy decoding only)')
+        p.add_argument('--length-penalty', '-lp', dest='length_penalty', action='store',
+                       type=float, default=0.0,
+                       help='beam search length penalty weight (0 for none)')
+        p.add_argument('--max-decode-len', '-ml', dest='max_decode_len', action='store',
+                       type=int, default=0,
+                       help='maximum decoding steps (0 for the longest train description)')
         return p
     return wrapper
 
@@ -113,5 +131,14 @@ def train_args(parse_fn):
         p.add_argument('--dropout', '-dd', dest='dropout', action='store',
                        type=float, default=0.3,
                        help='minibatch size for model')
+        p.add_argument('--batch-sampler', '-bs', dest='batch_sampler', action='store',
+                       type=str, default='shuffle', choices=['shuffle', 'bucket'],
+                       help='shuffle: random minibatches, bucket: minibatches of similar arg_name/arg_desc lengths')
+        p.add_argument('--prefetch-depth', '-pd', dest='prefetch_depth', action='store',
+                       type=int, default=2,
+                       help='number of minibatches built ahead in a background thread (0 to disable)')
+        p.add_argument('--input-mode', '-im', dest='input_mode', action='store',
+                       type=str, default='feed', choices=['feed', 'graph'],
+                       help='feed: feed every minibatch, graph: hold the data in the graph and feed only row indices')
         return p
     return wrapper
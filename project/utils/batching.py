@@ -0,0 +1,279 @@
+'''Ragged int tensors and padding helpers for building minibatches.
+
+A RaggedTensor keeps rows of different lengths as one flat values array and
+[n+1] row offsets, so long, variable length fields (like the code2vec paths)
+are stored without padding and each minibatch is only padded to its own
+longest row.
+'''
+from itertools import chain
+import queue
+import threading
+import time
+
+import numpy as np
+
+
+def pad_rows(values, lengths, width, dtype=np.int32):
+    '''Scatter the concatenated rows in `values` (row i has lengths[i] items,
+    each at most width) into a zero padded [n, width] array.'''
+    lengths = np.asarray(lengths)
+    out = np.zeros((len(lengths), width), dtype=dtype)
+    out[np.arange(width) < lengths[:, None]] = values
+    return out
+
+
+class RaggedTensor(object):
+    '''Rows of varying length, stored as flat values with row offsets.'''
+
+    def __init__(self, values, offsets):
+        self.values = values
+        self.offsets = offsets
+
+    @classmethod
+    def from_rows(cls, rows, max_len=None, dtype=np.int32):
+        '''Build from a sequence of rows, truncating each to max_len.'''
+        rows = list(rows)
+        if max_len is not None:
+            rows = [r[:max_len] for r in rows]
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum([len(r) for r in rows], out=offsets[1:])
+        values = np.fromiter(chain.from_iterable(rows), dtype=dtype, count=int(offsets[-1]))
+        return cls(values, offsets)
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    @property
+    def shape(self):
+        '''The shape of the dense version: [n, longest row + 1].'''
+        return (len(self), self.width())
+
+    def width(self):
+        '''Longest row, plus one so every dense row ends in a PAD.'''
+        return int(self.lengths.max()) + 1 if len(self) else 1
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.values[self.offsets[i]:self.offsets[i + 1]]
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            if key < 0:
+                key += len(self)
+            return self.values[self.offsets[key]:self.offsets[key + 1]]
+
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step == 1:
+                stop = max(start, stop)
+                offsets = self.offsets[start:stop + 1]
+                values = self.values[offsets[0]:offsets[-1]]
+                return RaggedTensor(values, offsets - offsets[0])
+            key = np.arange(start, stop, step)
+
+        return self.take(key)
+
+    def take(self, idx):
+        '''Gather the rows at the index array idx into a new RaggedTensor.'''
+        idx = np.asarray(idx, dtype=np.int64)
+        starts = self.offsets[idx]
+        lengths = self.offsets[idx + 1] - starts
+
+        offsets = np.zeros(len(idx) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        positions = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return RaggedTensor(self.values[positions], offsets)
+
+    def to_dense(self, width=None):
+        '''[n, width] zero padded array, by default as narrow as possible.'''
+        if width is None:
+            width = self.width()
+        return pad_rows(self.values, self.lengths, width, dtype=self.values.dtype)
+
+
+def pad_batch(rows):
+    '''Pad a minibatch of variable length rows to its own longest row + 1.'''
+    if isinstance(rows, RaggedTensor):
+        return rows.to_dense()
+    return RaggedTensor.from_rows(rows).to_dense()
+
+
+def sequence_lengths(column):
+    '''Length of every row of a padded (or ragged) int column, up to its first
+    PAD. None for anything else (e.g. the list of translations).'''
+    if isinstance(column, RaggedTensor):
+        return column.lengths
+    if isinstance(column, np.ndarray) and column.ndim == 2:
+        return np.argmax(column == 0, axis=1)
+    return None
+
+
+def gather(column, idx, lengths=None):
+    '''The rows idx of a column, with padded columns trimmed to the longest
+    selected row + 1 (so the argmin sequence lengths still work).'''
+    if isinstance(column, RaggedTensor):
+        return column.take(idx).to_dense()
+    if isinstance(column, np.ndarray):
+        if lengths is not None:
+            width = int(lengths[idx].max()) + 1 if len(idx) else 1
+            return column[idx, :width]
+        return column[idx]
+    return [column[i] for i in idx]
+
+
+def concat_columns(columns):
+    '''Concatenate the same column of several splits.'''
+    if isinstance(columns[0], RaggedTensor):
+        starts = np.cumsum([0] + [c.offsets[-1] for c in columns[:-1]])
+        offsets = np.concatenate([c.offsets[:-1] + s for c, s in zip(columns, starts)] +
+                                 [[starts[-1] + columns[-1].offsets[-1]]])
+        return RaggedTensor(np.concatenate([c.values for c in columns]), offsets.astype(np.int64))
+    return np.concatenate(columns)
+
+
+class IndexedBatch(tuple):
+    '''A minibatch (a tuple of columns, possibly empty) that also carries the
+    index of its rows in the data held in the graph.'''
+
+    def __new__(cls, columns, index):
+        batch = super().__new__(cls, columns)
+        batch.index = index
+        return batch
+
+
+def make_batch(full_data, idx, lengths=None, offset=None, index_only=False):
+    '''The minibatch of rows idx. If offset is given it is an IndexedBatch into
+    data held in the graph that starts at offset.'''
+    if lengths is None:
+        lengths = [None] * len(full_data)
+    columns = () if index_only else tuple(gather(d, idx, l) for d, l in zip(full_data, lengths))
+    if offset is None:
+        return columns
+    return IndexedBatch(columns, (idx + offset).astype(np.int32))
+
+
+def shuffled_batches(full_data, batch_size, shuffle=True, offset=None, index_only=False):
+    '''Minibatches of full_data gathered through one (shuffled) permutation of
+    the row indices, so no per-example tuples are built.'''
+    size = len(full_data[0])
+    perm = np.random.permutation(size) if shuffle else np.arange(size)
+    for start in range(0, size, batch_size):
+        idx = perm[start:start + batch_size]
+        yield make_batch(full_data, idx, offset=offset, index_only=index_only)
+
+
+def bucket_batches(keys, batch_size, pool_size=100):
+    '''Split a random permutation into pools of pool_size batches, sort each
+    pool by keys (primary key first) and cut it into batches, then shuffle
+    the batches. Batches hold examples of similar lengths while every epoch
+    still sees a different grouping.'''
+    perm = np.random.permutation(len(keys[0]))
+    pool = batch_size * pool_size
+
+    batches = []
+    for start in range(0, len(perm), pool):
+        chunk = perm[start:start + pool]
+        chunk = chunk[np.lexsort([k[chunk] for k in reversed(keys)])]
+        batches.extend(chunk[i:i + batch_size] for i in range(0, len(chunk), batch_size))
+    np.random.shuffle(batches)
+    return batches
+
+
+class BatchStats(object):
+    '''Examples per second, the fraction of fed int cells that are PAD and
+    how long the consumer spent waiting for input.'''
+
+    def __init__(self):
+        self.start = time.time()
+        self.examples = 0
+        self.cells = 0
+        self.pads = 0
+        self.input_wait = 0.0
+
+    def update(self, minibatch):
+        if isinstance(minibatch, IndexedBatch):
+            self.examples += len(minibatch.index)
+        else:
+            self.examples += len(minibatch[0])
+        for column in minibatch:
+            if isinstance(column, np.ndarray) and column.ndim == 2:
+                self.cells += column.size
+                self.pads += column.size - np.count_nonzero(column)
+
+    def __str__(self):
+        elapsed = max(time.time() - self.start, 1e-9)
+        return "{} examples, {:.1f} examples/sec, padding ratio {:.3f}, input wait {:.1f}s of {:.1f}s".format(
+            self.examples, self.examples / elapsed, self.pads / max(self.cells, 1),
+            self.input_wait, elapsed)
+
+
+def instrumented(batches, log, name=''):
+    '''Pass through (epoch, minibatch) pairs, logging BatchStats for every
+    epoch. Time not spent waiting for input is time spent by the consumer
+    (training steps, and any evaluation it runs).'''
+    batches = iter(batches)
+    stats, epoch = BatchStats(), None
+    while True:
+        wait_start = time.time()
+        try:
+            e, minibatch = next(batches)
+        except StopIteration:
+            break
+        waited = time.time() - wait_start
+
+        if e != epoch:
+            if epoch is not None:
+                log("EPOCH {} {}: {}".format(epoch, name, stats))
+            stats, epoch = BatchStats(), e
+        stats.input_wait += waited
+        stats.update(minibatch)
+        yield e, minibatch
+
+    if epoch is not None:
+        log("EPOCH {} {}: {}".format(epoch, name, stats))
+
+
+_END_OF_BATCHES = object()
+
+
+def prefetch(batches, depth):
+    '''Build the items of `batches` in a background thread, up to `depth`
+    ahead of the consumer. Errors in the producer are re-raised in the
+    consumer; closing the generator stops the producer.'''
+    buffer = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for b in batches:
+                if not put((b, None)):
+                    return
+            put((_END_OF_BATCHES, None))
+        except Exception as e:
+            put((None, e))
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item, error = buffer.get()
+            if error is not None:
+                raise error
+            if item is _END_OF_BATCHES:
+                return
+            yield item
+    finally:
+        stop.set()
@@ -0,0 +1,255 @@
+'''Micro benchmarks comparing optimised code paths against the implementations
+they replaced. Where the output is deterministic, a benchmark checks the two
+give identical results before reporting timings.
+
+    python -m project.utils.benchmarks vocab -F
+'''
+from collections import Counter, defaultdict
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+
+from project.external.nmt import bleu
+from project.utils import args
+from project.utils import batching
+from project.utils import code_tokenize
+from project.utils import tokenize
+
+
+def timed(fn, *fn_args, repeats=1, **fn_kwargs):
+    '''Run fn `repeats` times and return (result, best time in seconds).'''
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn(*fn_args, **fn_kwargs)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def report(name, old_time, new_time):
+    print("{:<30} old {:>9.3f}s   new {:>9.3f}s   x{:.1f}".format(
+        name, old_time, new_time, old_time / max(new_time, 1e-9)))
+
+
+def peak_memory(fn, *fn_args, **fn_kwargs):
+    '''Run fn and return (result, peak python allocation in MB).'''
+    tracemalloc.start()
+    try:
+        result = fn(*fn_args, **fn_kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, peak / 2**20
+
+
+def _list_build_vocab(common_tokens, file_voc, vocab_size, min_count, vocab=None):
+    '''The original list based selection, kept as a reference.'''
+    vocab = list(vocab) if vocab is not None else []
+    file_voc = list(file_voc)
+    for tok, count in common_tokens:
+
+        if tok in file_voc and count > min_count:
+            vocab.append(tok)
+            file_voc.remove(tok)
+
+        if len(vocab) > vocab_size:
+            break
+
+    if len(vocab) < vocab_size:
+        vocab.extend(file_voc[:vocab_size - len(vocab)])
+    return vocab
+
+
+def bench_vocab(opts):
+    train_data = tokenize.get_data_tuple(opts.use_full_dataset, opts.use_split_dataset,
+                                         opts.no_dups).train
+    embed_file = tokenize.get_embed_filenames()[opts.desc_embed]
+
+    all_toks = []
+    for toks in tokenize.nltk_tok_batch([d['arg_desc'] for d in train_data]):
+        all_toks.extend(toks)
+    common_tokens = Counter(all_toks).most_common()
+    file_voc = tokenize.load_glove_vocab(embed_file)
+
+    settings = [("gen_train_vocab", 4, None),
+                ("gen_desc_vocab_file", 2, ["<unk>", "<s>", "</s>"])]
+    for name, min_count, initial in settings:
+        old, old_time = timed(_list_build_vocab, common_tokens, file_voc,
+                              opts.vocab_size, min_count, vocab=initial)
+        new, new_time = timed(tokenize.build_vocab, common_tokens, file_voc,
+                              opts.vocab_size, min_count, vocab=initial,
+                              repeats=opts.repeats)
+        assert old == new, "{}: vocabularies differ".format(name)
+        report(name, old_time, new_time)
+
+
+def _zip_batches(full_data, batch_size):
+    '''The original batcher: shuffle a list of per-example tuples, transpose
+    it back and slice windows.'''
+    size = len(full_data[0])
+    ragged = [isinstance(d, batching.RaggedTensor) for d in full_data]
+    zipped = list(zip(*full_data))
+    np.random.shuffle(zipped)
+    shuffled = list(zip(*zipped))
+    for start in range(0, size, batch_size):
+        mb_data = [d[start:start + batch_size] for d in shuffled]
+        yield tuple(batching.pad_batch(d) if r else d for d, r in zip(mb_data, ragged))
+
+
+def _consume(batches):
+    n = 0
+    for mb in batches:
+        n += len(mb[0])
+    return n
+
+
+def bench_batching(opts):
+    _, data_tuple = tokenize.get_embed_tuple_and_data_tuple(**vars(opts))
+    train = data_tuple.train
+
+    for name, batcher in [("zip shuffle", _zip_batches),
+                          ("permutation", batching.shuffled_batches)]:
+        (n, elapsed), peak = peak_memory(timed, _consume, batcher(train, opts.batch_size))
+        print("{:<30} {} examples  {:>9.3f}s/epoch  peak {:>9.1f}MB".format(
+            name, n, elapsed, peak))
+
+
+def bench_input_mode(opts):
+    '''Training steps/sec of Code2VecEncoder with feed_dict and graph input.'''
+    import tensorflow as tf
+    from project.models.code2vec_encoder import Code2VecEncoder
+
+    kwargs = vars(opts).copy()
+    kwargs["bidirectional"] = kwargs["bidirectional"] > 0
+    embed_tuple, data_tuple = tokenize.get_embed_tuple_and_data_tuple(**kwargs)
+
+    times = {}
+    for input_mode in ["feed", "graph"]:
+        tf.reset_default_graph()
+        kwargs["input_mode"] = input_mode
+        nn = Code2VecEncoder(embed_tuple, **kwargs)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            if input_mode == "graph":
+                nn.load_graph_data(sess, data_tuple)
+
+            ops = [nn.update, nn.train_loss]
+            batches = nn._to_batch(data_tuple.train, epochs=opts.epochs, index_only=True)
+            minibatches = [mb for _, (_, mb) in zip(range(opts.steps + 1), batches)]
+            nn._feed_fwd(sess, minibatches[0], ops, 'TRAIN')  # warm up
+
+            start = time.perf_counter()
+            for mb in minibatches[1:]:
+                nn._feed_fwd(sess, mb, ops, 'TRAIN')
+            times[input_mode] = time.perf_counter() - start
+        print("{:<30} {:.1f} steps/sec".format(input_mode, (len(minibatches) - 1) / times[input_mode]))
+    report("code2vec_encoder input mode", times["feed"], times["graph"])
+
+
+def bench_bleu(opts):
+    '''Counter vs numpy n-gram counting on a synthetic 10k sentence eval set
+    (token ids, and the same as strings).'''
+    rng = np.random.RandomState(0)
+    def corpus():
+        return [rng.randint(1, opts.vocab_size, size=rng.randint(3, 30)).tolist() for _ in range(10000)]
+    references = [[r] for r in corpus()]
+    translations = [t[:len(t) // 2] + r[0][len(t) // 2:] for t, r in zip(corpus(), references)]
+
+    for name, refs, trans in [("ids", references, translations),
+                              ("strings", [[[str(w) for w in r[0]]] for r in references],
+                                          [[str(w) for w in t] for t in translations])]:
+        old, old_time = timed(bleu.compute_bleu, refs, trans, backend="counter")
+        new, new_time = timed(bleu.compute_bleu, refs, trans, backend="numpy", repeats=opts.repeats)
+        assert old == new, "bleu {}: scores differ".format(name)
+        report("bleu ({})".format(name), old_time, new_time)
+
+
+def _root_path_codepaths(cases):
+    return [code_tokenize.extract_paths_to_leaves(
+        arg_name, code_tokenize.extract_paths_from_root(tree, [], defaultdict(list)))
+        for tree, arg_name in cases]
+
+
+def _indexed_codepaths(cases):
+    return [code_tokenize.extract_indexed_paths_to_leaves(arg_name, code_tokenize.AstIndex(tree))
+            for tree, arg_name in cases]
+
+
+def _bounded_codepaths(cases, max_paths=None):
+    return [code_tokenize.extract_bounded_paths_to_leaves(arg_name, code_tokenize.AstIndex(tree), max_paths)
+            for tree, arg_name in cases]
+
+
+def bench_paths(opts):
+    '''Root path lists vs AstIndex on the --largest functions of the corpus:
+    memory held by the representation and time to extract all code paths,
+    pair by pair and bounded by LCA depth.'''
+    data = tokenize.get_data_tuple(opts.use_full_dataset, opts.use_split_dataset, opts.no_dups)
+    records = sorted(data.train + data.valid + data.test, key=lambda d: len(d['src']), reverse=True)
+
+    trees, cases = {}, []
+    for d in records:
+        if d['src'] not in trees:
+            if len(trees) == opts.largest:
+                continue
+            try:
+                trees[d['src']] = code_tokenize.get_ast(d)
+            except SyntaxError:
+                trees[d['src']] = None
+        if trees[d['src']] is not None:
+            cases.append((trees[d['src']], d['arg_name']))
+    trees = [t for t in trees.values() if t is not None]
+    print("{} functions, {} args, {} AST nodes".format(
+        len(trees), len(cases), sum(len(code_tokenize.AstIndex(t)) for t in trees)))
+
+    _, old_mem = peak_memory(lambda: [code_tokenize.extract_paths_from_root(t, [], defaultdict(list)) for t in trees])
+    _, new_mem = peak_memory(lambda: [code_tokenize.AstIndex(t) for t in trees])
+    print("{:<30} old {:>9.1f}MB  new {:>9.1f}MB".format("path representation", old_mem, new_mem))
+
+    old, old_time = timed(_root_path_codepaths, cases)
+    new, new_time = timed(_indexed_codepaths, cases, repeats=opts.repeats)
+    assert old == new, "code paths differ"
+    report("code paths", old_time, new_time)
+
+    bounded, bounded_time = timed(_bounded_codepaths, cases, repeats=opts.repeats)
+    assert old == bounded, "bounded code paths differ"
+    report("code paths (bounded)", old_time, bounded_time)
+
+
+BENCHMARKS = {
+    'bleu': bench_bleu,
+    'vocab': bench_vocab,
+    'batching': bench_batching,
+    'input_mode': bench_input_mode,
+    'paths': bench_paths,
+}
+
+
+@args.code2vec_args
+@args.encoder_args
+@args.train_args
+@args.data_args
+def _build_argparser():
+    parser = argparse.ArgumentParser(description='Benchmark optimised code paths')
+    parser.add_argument('benchmarks', nargs='*', default=sorted(BENCHMARKS),
+                        help='benchmarks to run: {}'.format(", ".join(sorted(BENCHMARKS))))
+    parser.add_argument('--repeats', '-R', dest='repeats', action='store',
+                        type=int, default=3,
+                        help='number of timed runs of the new code (best is reported)')
+    parser.add_argument('--steps', '-s', dest='steps', action='store',
+                        type=int, default=100,
+                        help='number of training steps timed by input_mode')
+    parser.add_argument('--largest', dest='largest', action='store',
+                        type=int, default=50,
+                        help='number of the largest functions used by paths')
+    return parser
+
+
+if __name__ == "__main__":
+    opts = _build_argparser().parse_args()
+    for b in opts.benchmarks:
+        print("Running benchmark: {}".format(b))
+        BENCHMARKS[b](opts)
@@ -1,9 +1,12 @@
+from array import array
 import ast
-from multiprocessing import Process, JoinableQueue, cpu_count
+from functools import partial
+import hashlib
+import pickle
+import random
+import sqlite3
+from multiprocessing import Pool, cpu_count
 from collections import defaultdict, namedtuple, Counter
-import queue
-import copy
-from time import sleep
 # import showast
 
 
@@ -11,88 +14,202 @@ CodePath = namedtuple("CodePath", ["from_var", "path", "to_var"])
 CodePath.__repr__ = lambda s: str(s[0]) + " | " + " ".join(["{}".format(p[0]) for p in s[1]]) + " | " + str(s[2])
 
 MAX_CODEPATH_LEN = 20
-
-def populate_codepath_point_worker(data_queue, error_queue, new_data_queue):
-    while True:
+# Paths kept per target variable (sampled), None for all of them
+MAX_PATHS_PER_VAR = None
+# CodePathCache used by extract_codepaths when none is given
+CODEPATH_CACHE = None
+# Bump when the extracted paths change, to invalidate cached ones
+CODEPATH_VERSION = 1
+
+def extract_codepath_strings(d, max_paths=None):
+    '''The code paths from d['arg_name'] to the other variables of d['src'],
+    as (path strings, target variable names)'''
+    tree = get_ast(d)
+    codepaths = extract_bounded_paths_to_leaves(d['arg_name'], AstIndex(tree), max_paths)
+
+    path_strings = [" ".join([p[0] for p in cp.path]) for cp in codepaths]
+    target_var_names = [cp.to_var for cp in codepaths]
+    return path_strings, target_var_names
+
+def index_codepaths(d, voc2idx_path, voc2idx_tv):
+    '''Fill in the path and target variable indices of a record with
+    path_strings and target_var_string (0 when out of vocabulary)'''
+    names = list(set(d["target_var_string"]))
+    name_dict = {n:i for i,n in enumerate(names)}
+    d['path_idx'] = [voc2idx_path[p] if p in voc2idx_path else 0 for p in d["path_strings"] ]
+    d['target_var_idx'] = [voc2idx_tv[p] if p in voc2idx_tv else 0 for p in d["target_var_string"]]
+    d['target_var_mask_idx'] = [name_dict[p] for p in d["target_var_string"]]
+    d['target_var_mask_names'] = names
+    return d
+
+# Failures that happen again whenever the same source is extracted (parse
+# errors, unsupported trees), so they can be cached. Anything else (e.g.
+# MemoryError, RecursionError) may not and only skips the record this time.
+DETERMINISTIC_ERRORS = (SyntaxError, ValueError, IndexError, UnboundLocalError)
+
+def _extract_chunk(chunk, max_paths=None):
+    '''Worker: [(i, src, arg_name)] -> [(i, path_strings, target_var_names,
+    error, transient)], error being None or why no paths were extracted and
+    transient whether that error might not happen again'''
+    results = []
+    for i, src, arg_name in chunk:
+        transient = False
         try:
-            i,d = data_queue.get()
-            tree = get_ast(d)
-            paths_from_root = extract_paths_from_root(tree, [], defaultdict(list))
-            codepaths = extract_paths_to_leaves(d['arg_name'], paths_from_root)
-            # d["codepaths"] = codepaths
-
-            path_strings = []
-            target_var_names = []
-            for cp in codepaths:
-                ps = " ".join([p[0] for p in cp.path])
-                path_strings.append(ps)
-
-                tv = cp.to_var
-                target_var_names.append(tv)
-
-            d["path_strings"] = path_strings
-            d["target_var_string"] = target_var_names
-            if codepaths:
-                new_data_queue.put(d)
-            else:
-                error_queue.put(i)
-                # print("NO PATHS in {}: name: {} pkg: {}".format(i, d['arg_name'], d['pkg']))
-            data_queue.task_done()
-        except SyntaxError:
-            error_queue.put(i)
-            # print("SYNTAX ERROR in {}: name: {} pkg: {}".format(i, d['arg_name'], d['pkg']))
-            data_queue.task_done()
-        except queue.Empty:
-            return
-    return
-
-def pop_queue_closure(our_list):
-    return_list = our_list
-    def pop_queue(q):
-        while True:
-            try:
-                item = q.get_nowait()
-
-                return_list.append(item)
-                q.task_done()
-            except queue.Empty:
-                break
-    return pop_queue
-
-def return_populated_codepath(data):
-    error_queue = JoinableQueue()
-    error_list = []
-    new_data_queue = JoinableQueue()
-    new_data_list = []
-
-    data_queue = JoinableQueue()
-    [data_queue.put_nowait((i,d)) for i, d in enumerate(data)]
-
-
-    num_worker_threads = min(20, cpu_count() - 2)
-    jobs = []
-
-    print("Starting {} Processes".format(num_worker_threads))
-    for _ in range(num_worker_threads - 1):
-        p = Process(target=populate_codepath_point_worker,
-                                    args=(data_queue, error_queue, new_data_queue))
-        p.start()
-        jobs.append(p)
-
-    func_lists = []
-    for q, l in [(error_queue, error_list), (new_data_queue, new_data_list)]:
-        func = pop_queue_closure(l)
-        func_lists.append((func, q))
-
-    while len(error_list) + len(new_data_list) != len(data):
-        print(len(error_list), len(new_data_list), len(data), end="\r")
-        [func(q) for func, q in func_lists]
+            path_strings, target_var_names = extract_codepath_strings({'src': src, 'arg_name': arg_name},
+                                                                      max_paths)
+            error = None if path_strings else "no code paths"
+        except Exception as e:
+            path_strings, target_var_names = [], []
+            error = type(e).__name__
+            transient = not isinstance(e, DETERMINISTIC_ERRORS)
+        results.append((i, path_strings, target_var_names, error, transient))
+    return results
+
+def codepath_key(src, arg_name, max_paths=None):
+    '''Hash of everything the code paths of arg_name in src depend on'''
+    sha = hashlib.sha1()
+    sha.update("{}\0{}\0{}\0{}\0".format(CODEPATH_VERSION, MAX_CODEPATH_LEN, max_paths, arg_name)
+               .encode('utf-8', 'surrogatepass'))
+    sha.update(clear_leading_indent(src).encode('utf-8', 'surrogatepass'))
+    return sha.hexdigest()
+
+class CodePathCache(object):
+    '''Extracted code paths on disk (sqlite), by codepath_key: for every
+    (src, arg_name) its (path_strings, target_var_names, error), as returned
+    by _extract_chunk. Counts hits and misses over its lifetime.'''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.conn = sqlite3.connect(filename)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS codepaths (key TEXT PRIMARY KEY, value BLOB)")
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, keys, batch_size=500):
+        keys = list(set(keys))
+        found = {}
+        for start in range(0, len(keys), batch_size):
+            batch = keys[start:start + batch_size]
+            rows = self.conn.execute("SELECT key, value FROM codepaths WHERE key IN ({})".format(
+                ",".join("?" * len(batch))), batch)
+            found.update((k, pickle.loads(v)) for k, v in rows)
+        return found
+
+    def put_many(self, items):
+        self.conn.executemany("INSERT OR REPLACE INTO codepaths VALUES (?, ?)",
+                              ((k, pickle.dumps(v, pickle.HIGHEST_PROTOCOL)) for k, v in items))
+        self.conn.commit()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM codepaths").fetchone()[0]
+
+    def summary(self):
+        total = self.hits + self.misses
+        return "Code path cache {}: {} hits, {} misses ({:.1f}% hit rate), {} entries".format(
+            self.filename, self.hits, self.misses, 100.0 * self.hits / max(total, 1), len(self))
+
+    def close(self):
+        self.conn.close()
+
+def extract_codepaths(data, processes=None, chunksize=200, max_paths=None, cache=None):
+    '''Extract the code path strings of every record in data, sending only the
+    src and arg_name of chunksize records at a time to a process pool.
+    max_paths caps the paths per target variable (MAX_PATHS_PER_VAR by default).
+    With a CodePathCache (CODEPATH_CACHE by default), only records not in it
+    are extracted, once per distinct (src, arg_name), and then added to it
+    unless they failed with an error not in DETERMINISTIC_ERRORS.
+    Returns ({i: (path_strings, target_var_names)} for the records with code
+    paths, {i: reason} for the others)'''
+    if processes is None:
+        processes = max(1, min(20, cpu_count() - 2))
+    if max_paths is None:
+        max_paths = MAX_PATHS_PER_VAR
+    if cache is None:
+        cache = CODEPATH_CACHE
+    extract_chunk = partial(_extract_chunk, max_paths=max_paths)
+
+    if cache is not None:
+        keys = [codepath_key(d['src'], d['arg_name'], max_paths) for d in data]
+        cached = cache.get_many(keys)
+        todo, queued = [], set()
+        for i, key in enumerate(keys):
+            if key not in cached and key not in queued:
+                queued.add(key)
+                todo.append(i)
+        cache.misses += len(todo)
+        cache.hits += len(data) - len(todo)
+    else:
+        todo = range(len(data))
+
+    chunks = [[(i, data[i]['src'], data[i]['arg_name']) for i in todo[start:start + chunksize]]
+              for start in range(0, len(todo), chunksize)]
+
+    if processes > 1 and len(chunks) > 1:
+        print("Starting {} Processes".format(processes))
+        pool = Pool(processes)
+        results = pool.imap_unordered(extract_chunk, chunks)
+    else:
+        pool = None
+        results = map(extract_chunk, chunks)
+
+    extracted, transient = {}, set()
+    try:
+        for chunk_results in results:
+            for i, path_strings, target_var_names, error, is_transient in chunk_results:
+                extracted[i] = (path_strings, target_var_names, error)
+                if is_transient:
+                    transient.add(i)
+            if cache is not None:
+                cache.put_many((keys[i], extracted[i]) for i, _, _, _, is_transient in chunk_results
+                               if not is_transient)
+            print(len(extracted), len(todo), end="\r")
+    except BaseException:
+        # Do not wait for the queued chunks
+        if pool is not None:
+            pool.terminate()
+        raise
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if cache is not None:
+        cached.update((keys[i], result) for i, result in extracted.items())
+        extracted = {i: cached[key] for i, key in enumerate(keys)}
+    if transient:
+        print("Not cached, may succeed next time: {}".format(
+            dict(Counter(extracted[i][2] for i in transient))))
+
+    paths, errors = {}, {}
+    for i, (path_strings, target_var_names, error) in extracted.items():
+        if error is None:
+            paths[i] = (path_strings, target_var_names)
+        else:
+            errors[i] = error
 
-    print(len(error_list), len(new_data_list), len(data), end="\r")
-    [j.terminate() for j in jobs]
-    print("Closed Processes")
+    print("Code paths for {} of {} records, skipped: {}".format(
+        len(paths), len(data), dict(Counter(errors.values()))))
+    if cache is not None:
+        print(cache.summary())
+    return paths, errors
 
-    return new_data_list
+def return_populated_codepath(data):
+    '''Return the records of data that have code paths, populated with
+    path_strings and target_var_string, in their original order'''
+    populated = populate_codepath_index(data)
+    return [populated[i] for i in sorted(populated)]
+
+def populate_codepath_index(data):
+    '''Return a map from index in data to the populated copy of that record,
+    for every record that has code paths'''
+    paths, _ = extract_codepaths(data)
+
+    populated = {}
+    for i, (path_strings, target_var_names) in paths.items():
+        d = data[i].copy()
+        d["path_strings"] = path_strings
+        d["target_var_string"] = target_var_names
+        populated[i] = d
+    return populated
 
 def get_pure_src(d):
     src = clear_leading_indent(d['src'])
@@ -171,18 +288,21 @@ def ignore_connecting_path(connecting_path):
     return len(connecting_path) > MAX_CODEPATH_LEN
 
 def ignore_path(cpath, path):
-    filtered_out = [
-        tuple(["ClassDef","FunctionDef", "arguments", "arg"]),
-        tuple(["FunctionDef", "arguments", "arg"]),
-        tuple(["FunctionDef"])
-    ]
-
-    banned_ending = ['keywords', 'keyword']
     path_tuple = tuple(p[0] for p in path)
     cpath_tuple = tuple(p[0] for p in cpath)
-    return path_tuple in filtered_out \
-            or cpath_tuple in filtered_out \
-            or cpath_tuple[-1] in banned_ending
+    return _ignore_types(cpath_tuple, path_tuple)
+
+IGNORED_PATHS = [
+    tuple(["ClassDef","FunctionDef", "arguments", "arg"]),
+    tuple(["FunctionDef", "arguments", "arg"]),
+    tuple(["FunctionDef"])
+]
+BANNED_ENDINGS = ['keywords', 'keyword']
+
+def _ignore_types(cpath_tuple, path_tuple):
+    return path_tuple in IGNORED_PATHS \
+            or cpath_tuple in IGNORED_PATHS \
+            or cpath_tuple[-1] in BANNED_ENDINGS
 
 def extract_paths_to_leaves(variable, pmap):
     core_paths = pmap[variable]
@@ -256,6 +376,275 @@ def extract_paths_from_root(node, path, pmap, accept_nonvar_terminals=False):
     return pmap
 
 
+# Node class names interned as small ints, for AstIndex
+NODE_TYPE_IDS = {}
+NODE_TYPE_NAMES = []
+
+def intern_node_type(name):
+    type_id = NODE_TYPE_IDS.get(name)
+    if type_id is None:
+        type_id = NODE_TYPE_IDS[name] = len(NODE_TYPE_NAMES)
+        NODE_TYPE_NAMES.append(name)
+    return type_id
+
+UP = ("<-", None)
+DOWN = ("->", None)
+
+def _node_items(node, accept_nonvar_terminals=False):
+    '''(child, None) for each child node and (None, terminal) for each terminal
+    of node, in the order extract_paths_from_root visits them'''
+    nodes_with_docstring = isinstance(node, (ast.FunctionDef, ast.ClassDef, ast.Module))
+    for name, field in node_gen(node):
+        if isinstance(field, list):
+            if nodes_with_docstring and name == 'body':
+                field = _strip_docstring(field)
+            for f in field:
+                if isinstance(f, ast.AST):
+                    yield f, None
+                else:
+                    yield None, f
+        elif isinstance(field, ast.AST):
+            if field._fields:
+                yield field, None
+            elif accept_nonvar_terminals:
+                yield None, field.__class__.__name__
+        elif field is not None:
+            yield None, field
+
+class AstIndex(object):
+    '''The nodes of an AST as parent pointer, depth and interned node type
+    arrays, and for every terminal (as keyed by extract_paths_from_root) the
+    nodes it occurs in. A node's path from the root (which itself is on no
+    path) is implicit in the parent pointers, so no path is stored per
+    terminal occurrence.'''
+
+    def __init__(self, tree, accept_nonvar_terminals=False):
+        self.parents = array('i', [-1])
+        self.depths = array('i', [0])
+        self.types = array('i', [intern_node_type(tree.__class__.__name__)])
+        self.node_ids = array('q', [id(tree)])
+        self.terminals = defaultdict(list)
+        self._node_types = None
+        self._first = None
+        self._sparse = None
+
+        # Depth first, without recursion
+        stack = [(0, _node_items(tree, accept_nonvar_terminals))]
+        while stack:
+            k, items = stack[-1]
+            for child, terminal in items:
+                if child is not None:
+                    stack.append((self._add_node(child, k), _node_items(child, accept_nonvar_terminals)))
+                    break
+                self.terminals[terminal].append(k)
+            else:
+                stack.pop()
+
+    def _add_node(self, node, parent):
+        self.parents.append(parent)
+        self.depths.append(self.depths[parent] + 1)
+        self.types.append(intern_node_type(node.__class__.__name__))
+        self.node_ids.append(id(node))
+        return len(self.parents) - 1
+
+    def __len__(self):
+        return len(self.parents)
+
+    def root_path(self, k):
+        '''The nodes from just below the root down to k.'''
+        path = []
+        while k > 0:
+            path.append(k)
+            k = self.parents[k]
+        path.reverse()
+        return path
+
+    def type_names(self, path):
+        return tuple(NODE_TYPE_NAMES[self.types[k]] for k in path)
+
+    def node_type(self, k):
+        '''k as node_type describes its node'''
+        return NODE_TYPE_NAMES[self.types[k]], self.node_ids[k]
+
+    def _node_type_list(self):
+        if self._node_types is None:
+            self._node_types = [(NODE_TYPE_NAMES[t], i) for t, i in zip(self.types, self.node_ids)]
+        return self._node_types
+
+    def _build_lca(self):
+        '''Euler tour of the tree, and a sparse table of the least depth on
+        every power of two long stretch of it'''
+        euler = array('i')
+        self._first = array('i', [0]) * len(self)
+        stack = []
+        # Nodes are numbered in depth first order
+        for k, parent in enumerate(self.parents):
+            while stack and stack[-1] != parent:
+                stack.pop()
+                euler.append(stack[-1])
+            self._first[k] = len(euler)
+            euler.append(k)
+            stack.append(k)
+
+        level = [self.depths[k] for k in euler]
+        self._sparse = [level]
+        span = 1
+        while 2 * span <= len(euler):
+            level = list(map(min, level, level[span:]))
+            self._sparse.append(level)
+            span *= 2
+
+    def lca_tables(self):
+        '''(first Euler tour position of each node, sparse table of depths)'''
+        if self._sparse is None:
+            self._build_lca()
+        return self._first, self._sparse
+
+    def lca_depth(self, a, b):
+        '''Depth of the lowest common ancestor of nodes a and b, in O(1).'''
+        first, sparse = self.lca_tables()
+        i, j = first[a], first[b]
+        if i > j:
+            i, j = j, i
+        level = (j - i + 1).bit_length() - 1
+        row = sparse[level]
+        return min(row[i], row[j - (1 << level) + 1])
+
+    def connecting_path(self, pathA, pathB, root=None):
+        '''extract_connecting_path of two root paths of this index.'''
+        if root is None:
+            root = get_root_index(pathA, pathB)
+        return self.up_half(pathA, root) + self.down_half(pathB, root)
+
+    def up_half(self, pathA, root):
+        '''The part of a connecting path from the end of pathA up to root'''
+        node_types = self._node_type_list()
+        ups = [node_types[a] for a in reversed(pathA[root:])]
+        half = [UP] * (2 * len(ups) - 1)
+        half[::2] = ups
+        return half
+
+    def down_half(self, pathB, root):
+        '''The part of a connecting path from below root down to the end of pathB'''
+        node_types = self._node_type_list()
+        downs = [node_types[b] for b in pathB[root+1:]]
+        half = [DOWN] * (2 * len(downs))
+        half[1::2] = downs
+        return half
+
+def extract_indexed_paths_to_leaves(variable, index):
+    '''extract_paths_to_leaves for an AstIndex: root paths are only built
+    while they are needed.'''
+    core = index.terminals[variable]
+    core_paths = [index.root_path(k) for k in core]
+    core_types = [index.type_names(cpath) for cpath in core_paths]
+
+    path_tuple_list = []
+    for other_var, nodes in index.terminals.items():
+        if other_var == variable:
+            continue
+        for k in nodes:
+            path = index.root_path(k)
+            path_types = index.type_names(path)
+            for cpath, cpath_types in zip(core_paths, core_types):
+                if _ignore_types(cpath_types, path_types):
+                    continue
+                connecting_path = index.connecting_path(cpath, path)
+                if ignore_connecting_path(connecting_path):
+                    continue
+                path_tuple_list.append(CodePath(variable, connecting_path, other_var))
+    return path_tuple_list
+
+
+def indexed_root_index(len_a, len_b, common):
+    '''get_root_index of two root paths of lengths len_a and len_b (> 0) whose
+    first `common` nodes are the same'''
+    if common == len_a:
+        return len_a - 1
+    if common == len_b:
+        return 0
+    return common - 1
+
+def connecting_path_len(len_a, len_b, root):
+    '''len of extract_connecting_path for root paths of lengths len_a and len_b
+    joined at root, as returned by get_root_index'''
+    ups = len_a - root if root >= 0 else 1
+    downs = max(0, len_b - root - 1)
+    return 2 * ups - 1 + 2 * downs
+
+_MAX_IGNORED_LEN = max(len(p) for p in IGNORED_PATHS)
+
+def sample_paths_per_var(codepaths, max_paths, seed=0):
+    '''At most max_paths code paths to each target variable, sampled with a
+    fixed seed and kept in their original order'''
+    by_var = defaultdict(list)
+    for i, cp in enumerate(codepaths):
+        by_var[cp.to_var].append(i)
+
+    rng = random.Random(seed)
+    keep = []
+    for indices in by_var.values():
+        if len(indices) > max_paths:
+            indices = rng.sample(indices, max_paths)
+        keep.extend(indices)
+    return [codepaths[i] for i in sorted(keep)]
+
+def extract_bounded_paths_to_leaves(variable, index, max_paths=None, seed=0):
+    '''extract_indexed_paths_to_leaves, measuring every pair from the depth of
+    its lowest common ancestor so that only the paths kept are built: none
+    over MAX_CODEPATH_LEN and, with max_paths, at most that many per target
+    variable (the same sample as sample_paths_per_var).'''
+    core = index.terminals[variable]
+    if 0 in core:
+        # Terminals of the root have an empty root path, leave them to the reference
+        codepaths = extract_indexed_paths_to_leaves(variable, index)
+        return codepaths if max_paths is None else sample_paths_per_var(codepaths, max_paths, seed)
+
+    # The ignore rules for the variable's side do not depend on the other side
+    cores = [(c, cpath, {}) for c, cpath in ((c, index.root_path(c)) for c in core)
+             if not _ignore_types(index.type_names(cpath), ())]
+    depths = index.depths
+    first, sparse = index.lca_tables()
+    rng = random.Random(seed)
+
+    codepaths = []
+    for other_var, nodes in index.terminals.items():
+        if other_var == variable:
+            continue
+        pairs = []
+        for k in nodes:
+            len_b = depths[k]
+            if len_b <= _MAX_IGNORED_LEN and index.type_names(index.root_path(k)) in IGNORED_PATHS:
+                continue
+            for core_entry in cores:
+                c = core_entry[0]
+                # index.lca_depth(c, k), inlined
+                i, j = first[c], first[k]
+                if i > j:
+                    i, j = j, i
+                level = (j - i + 1).bit_length() - 1
+                row = sparse[level]
+                common = min(row[i], row[j - (1 << level) + 1])
+
+                root = indexed_root_index(depths[c], len_b, common)
+                if connecting_path_len(depths[c], len_b, root) <= MAX_CODEPATH_LEN:
+                    pairs.append((k, core_entry, root))
+
+        if max_paths is not None and len(pairs) > max_paths:
+            pairs = [pairs[i] for i in sorted(rng.sample(range(len(pairs)), max_paths))]
+
+        # Both halves of a path repeat across pairs, build each once
+        paths, downs = {}, {}
+        for k, (c, cpath, ups), root in pairs:
+            if root not in ups:
+                ups[root] = index.up_half(cpath, root)
+            if (k, root) not in downs:
+                if k not in paths:
+                    paths[k] = index.root_path(k)
+                downs[k, root] = index.down_half(paths[k], root)
+            codepaths.append(CodePath(variable, ups[root] + downs[k, root], other_var))
+    return codepaths
+
 if __name__== "__main__":
     from project.data.preprocessed.split import split_data as DATA
 
@@ -0,0 +1,310 @@
+'''Columnar on-disk storage for lists of records (dicts).
+
+Every split is stored as a directory holding one contiguous array per field
+(plus offsets for ragged fields) and a small `columns.json` index. Arrays are
+saved as .npy files and memory-mapped on load. Loaded records are views onto
+the mapped columns that decode a value only when it is read, so reading a
+split is bounded by page-ins rather than by parsing.
+
+Column kinds:
+    str:      utf-8 bytes of every value concatenated, with [n+1] byte offsets
+    int_list: every list concatenated into one int64 array, with [n+1] offsets
+    str_list: a `str` column of all the items, with [n+1] item offsets per row
+    json:     json encoded per record into a `str` column, for values that
+              come back unchanged from json
+    pickle:   anything else, pickled per record into a bytes column
+
+A column of values that can be None has a `nulls` mask, and a field some
+records do not have a `present` mask; the index says which masks a column has.
+'''
+from collections.abc import Mapping
+import json
+import os
+import pickle
+import shutil
+
+import numpy as np
+
+# json rather than yaml: project.data.preprocessed overrides how yaml loads booleans
+INDEX_FILE = 'columns.json'
+COLUMNAR_SUFFIX = '.cols'
+
+
+def _encode(s):
+    return s.encode('utf-8', 'surrogatepass')
+
+
+def _decode(b):
+    return str(b, 'utf-8', 'surrogatepass')
+
+
+def _column_kind(values):
+    if all(v is None or isinstance(v, str) for v in values):
+        return 'str'
+    if not all(isinstance(v, list) for v in values):
+        return 'json'
+
+    items = [i for v in values for i in v]
+    if all(isinstance(i, str) for i in items):
+        return 'str_list'
+    if all(isinstance(i, (int, np.integer)) and not isinstance(i, bool) for i in items):
+        return 'int_list'
+    return 'json'
+
+
+def _json_safe(values):
+    '''Whether every value comes back from json unchanged (no tuples, no non
+    str dict keys, ...)'''
+    try:
+        return json.loads(json.dumps(values)) == values
+    except (TypeError, ValueError):
+        return False
+
+
+def _save_array(path, field, part, array):
+    np.save('{}/{}.{}.npy'.format(path, field, part), array)
+
+
+def _load_array(path, field, part):
+    return np.load('{}/{}.{}.npy'.format(path, field, part), mmap_mode='r')
+
+
+def _row_offsets(lengths):
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+def _save_bytes(path, field, encoded):
+    _save_array(path, field, 'data', np.frombuffer(b''.join(encoded), dtype=np.uint8))
+    _save_array(path, field, 'offsets', _row_offsets([len(e) for e in encoded]))
+
+
+class _BytesColumn(object):
+    '''The i-th value of a column saved by _save_bytes, read from the mapped arrays.'''
+
+    def __init__(self, path, field):
+        self.data = _load_array(path, field, 'data')
+        self.offsets = _load_array(path, field, 'offsets')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.data[int(self.offsets[i]):int(self.offsets[i+1])].tobytes()
+
+
+class _StrColumn(_BytesColumn):
+
+    def __getitem__(self, i):
+        return _decode(_BytesColumn.__getitem__(self, i))
+
+
+class _ListColumn(object):
+    '''Rows of [n+1] offsets into a flat column of items.'''
+
+    def __init__(self, items, offsets):
+        self.items = items
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        start, end = int(self.offsets[i]), int(self.offsets[i+1])
+        if isinstance(self.items, np.ndarray):
+            return self.items[start:end].tolist()
+        return [self.items[j] for j in range(start, end)]
+
+
+class _DecodedColumn(object):
+
+    def __init__(self, column, decode):
+        self.column = column
+        self.decode = decode
+
+    def __len__(self):
+        return len(self.column)
+
+    def __getitem__(self, i):
+        return self.decode(self.column[i])
+
+
+def _save_column(path, field, kind, values):
+    if kind == 'str':
+        _save_bytes(path, field, [b'' if v is None else _encode(v) for v in values])
+    elif kind == 'str_list':
+        _save_bytes(path, field + '.items', [_encode(i) for v in values for i in v])
+        _save_array(path, field, 'rows', _row_offsets([len(v) for v in values]))
+    elif kind == 'int_list':
+        _save_array(path, field, 'data', np.array([i for v in values for i in v], dtype=np.int64))
+        _save_array(path, field, 'offsets', _row_offsets([len(v) for v in values]))
+    elif kind == 'json':
+        _save_bytes(path, field, [_encode(json.dumps(v)) for v in values])
+    elif kind == 'pickle':
+        _save_bytes(path, field, [pickle.dumps(v, pickle.HIGHEST_PROTOCOL) for v in values])
+
+
+def _load_column(path, field, kind):
+    if kind == 'str':
+        return _StrColumn(path, field)
+    elif kind == 'str_list':
+        return _ListColumn(_StrColumn(path, field + '.items'), _load_array(path, field, 'rows'))
+    elif kind == 'int_list':
+        return _ListColumn(_load_array(path, field, 'data'), _load_array(path, field, 'offsets'))
+    elif kind == 'json':
+        return _DecodedColumn(_StrColumn(path, field), json.loads)
+    elif kind == 'pickle':
+        return _DecodedColumn(_BytesColumn(path, field), pickle.loads)
+
+
+def _write_columns(records, path):
+    fields = []
+    for r in records:
+        for k in r.keys():
+            if k not in fields:
+                fields.append(k)
+
+    columns = []
+    for f in fields:
+        present = [f in r for r in records]
+        values = [r[f] if p else None for r, p in zip(records, present)]
+        kind = _column_kind([v for v, p in zip(values, present) if p])
+        if kind == 'json' and not _json_safe(values):
+            kind = 'pickle'
+        if kind in ('str_list', 'int_list'):
+            # Placeholder rows for the records without the field
+            values = [v if p else [] for v, p in zip(values, present)]
+        _save_column(path, f, kind, values)
+
+        column = {'field': f, 'kind': kind, 'nulls': False, 'present': not all(present)}
+        if kind == 'str' and any(v is None for v, p in zip(values, present) if p):
+            column['nulls'] = True
+            _save_array(path, f, 'nulls', np.array([v is None for v in values], dtype=np.bool_))
+        if column['present']:
+            _save_array(path, f, 'present', np.array(present, dtype=np.bool_))
+        columns.append(column)
+
+    with open('{}/{}'.format(path, INDEX_FILE), 'w', encoding='utf-8') as f:
+        json.dump({"n": len(records), "columns": columns}, f)
+
+
+def save_records(records, path):
+    '''Save a list of records to the directory `path`, replacing whatever was
+    saved there before. The new columns are written next to it and swapped in
+    once complete.'''
+    tmp_path, old_path = path + '.tmp', path + '.old'
+    for p in [tmp_path, old_path]:
+        if os.path.exists(p):
+            shutil.rmtree(p)
+    os.makedirs(tmp_path)
+
+    _write_columns(records, tmp_path)
+    if os.path.exists(path):
+        os.rename(path, old_path)
+    os.rename(tmp_path, path)
+    if os.path.exists(old_path):
+        shutil.rmtree(old_path)
+
+
+class ColumnTable(object):
+    '''The memory-mapped columns of a directory written by save_records.'''
+
+    def __init__(self, path):
+        with open('{}/{}'.format(path, INDEX_FILE), 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        self.n = index["n"]
+        self.fields = []
+        self.columns = {}
+        self.nulls = {}
+        self.present = {}
+        for column in index["columns"]:
+            field = column['field']
+            self.fields.append(field)
+            self.columns[field] = _load_column(path, field, column['kind'])
+            if column['nulls']:
+                self.nulls[field] = _load_array(path, field, 'nulls')
+            if column['present']:
+                self.present[field] = _load_array(path, field, 'present')
+
+    def __len__(self):
+        return self.n
+
+    def has(self, field, i):
+        return field in self.columns and (field not in self.present or bool(self.present[field][i]))
+
+    def get(self, field, i):
+        if field in self.nulls and self.nulls[field][i]:
+            return None
+        return self.columns[field][i]
+
+    def records(self):
+        return [ColumnRecord(self, i) for i in range(self.n)]
+
+
+class ColumnRecord(Mapping):
+    '''Row i of a ColumnTable. Values are decoded from the mapped columns when
+    read; fields assigned later are kept on the record itself.'''
+    __slots__ = ['table', 'row', 'extra']
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+        self.extra = None
+
+    def __getitem__(self, key):
+        if self.extra is not None and key in self.extra:
+            return self.extra[key]
+        if not self.table.has(key, self.row):
+            raise KeyError(key)
+        return self.table.get(key, self.row)
+
+    def __setitem__(self, key, value):
+        if self.extra is None:
+            self.extra = {}
+        self.extra[key] = value
+
+    def __contains__(self, key):
+        return (self.extra is not None and key in self.extra) or self.table.has(key, self.row)
+
+    def __iter__(self):
+        for k in self.table.fields:
+            if self.table.has(k, self.row):
+                yield k
+        if self.extra is not None:
+            for k in self.extra:
+                if not self.table.has(k, self.row):
+                    yield k
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return "ColumnRecord({})".format(dict(self))
+
+    def __reduce__(self):
+        # Pickle as the plain dict, not the mapped table
+        return dict, (dict(self),)
+
+    def copy(self):
+        record = ColumnRecord(self.table, self.row)
+        record.extra = dict(self.extra) if self.extra is not None else None
+        return record
+
+
+def load_columns(path):
+    '''Return the number of records and a list of (field, list of values),
+    None where a record does not have the field.'''
+    table = ColumnTable(path)
+    return table.n, [(field, [table.get(field, i) if table.has(field, i) else None for i in range(table.n)])
+                     for field in table.fields]
+
+
+def load_records(path):
+    '''Load the records saved in `path` as ColumnRecords, which read their
+    values from the memory-mapped columns.'''
+    return ColumnTable(path).records()
+
+
+def is_columnar(path):
+    return os.path.isfile('{}/{}'.format(path, INDEX_FILE))
@@ -5,8 +5,8 @@ import os
 
 import numpy as np
 from project.utils.tokenize import get_data_tuple, choose_tokenizer, \
-                     CHAR_VOCAB, nltk_tok,\
-                     get_embed_filenames, get_weights_word2idx, \
+                     CHAR_VOCAB, nltk_tok_batch, build_vocab,\
+                     get_embed_filenames, get_weights_word2idx, load_glove_vocab, \
                      get_weights_char2idx
 
 NMT_PATH = "./nmt_data/{}"
@@ -36,9 +36,7 @@ def write_char_data_to_file(data, name):
             f.write("\n")
 
 def write_desc_data_to_file(data, name):
-    desc_seq = []
-    for d in data:
-        desc_seq.append(nltk_tok(d['arg_desc']))
+    desc_seq = nltk_tok_batch([d['arg_desc'] for d in data])
 
     with open(NMT_PATH.format(name+'.de'), 'w', encoding='utf-8') as f:
         for d in desc_seq:
@@ -54,29 +52,17 @@ def gen_char_vocab_file(name):
         for c in CHAR_VOCAB:
             f.write("{}\n".format(c))
 
-def gen_desc_vocab_file(train_data, vocab_size, dim, name):
+def gen_desc_vocab_file(train_data, vocab_size, dim, name, min_count=2):
     all_toks = []
-    for d in train_data:
-        all_toks.extend(nltk_tok(d['arg_desc']))
+    for toks in nltk_tok_batch([d['arg_desc'] for d in train_data]):
+        all_toks.extend(toks)
     common_tokens = Counter(all_toks).most_common()
 
 
     filename =  get_embed_filenames()[dim]
-    vocab = ["<unk>", "<s>", "</s>"]
-
-    with open(filename, 'r', encoding='utf-8') as f:
-        file_voc = [ line.split()[0] for line in f ]
-        for tok, count in common_tokens:
-
-            if tok in file_voc and count > 2:
-                vocab.append(tok)
-                file_voc.remove(tok)
-
-            if len(vocab) > vocab_size:
-                break
-
-        if len(vocab) < vocab_size:
-            vocab.extend(file_voc[:vocab_size - len(vocab)])
+    file_voc = load_glove_vocab(filename)
+    vocab = build_vocab(common_tokens, file_voc, vocab_size, min_count,
+                        vocab=["<unk>", "<s>", "</s>"])
 
     # vocab.extend(get_special_tokens())
 
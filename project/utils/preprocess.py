@@ -1,7 +1,15 @@
 import argparse
 from collections import Counter
+from collections.abc import Mapping
+from contextlib import contextmanager
+from functools import partial
+import hashlib
+import heapq
 import os
+import pickle
 import random
+import shutil
+import time
 
 import pyaml
 import yaml
@@ -9,8 +17,10 @@ from yaml import CLoader, CDumper
 from yaml.constructor import Constructor
 
 from project.data import preprocessed, data
-from project.utils.tokenize import nltk_tok
-from project.utils.code_tokenize import return_populated_codepath
+from project.utils import code_tokenize
+from project.utils.tokenize import nltk_tok_batch
+from project.utils.code_tokenize import return_populated_codepath, populate_codepath_index, \
+                                        index_codepaths
 random.seed(100)
 
 # Deal with Yaml 1.2 and 1.1 incompatibilty: Turn off 'on' == True (bool)
@@ -22,6 +32,26 @@ Constructor.add_constructor(u'tag:yaml.org,2002:bool', add_bool)
 
 RAWDATADIR = os.path.dirname(os.path.abspath(data.__file__))
 PREPROCESSDATADIR = os.path.dirname(os.path.abspath(preprocessed.__file__))
+# Code paths extracted by any builder and any run, see code_tokenize.CodePathCache
+CODEPATH_CACHE_FILE = PREPROCESSDATADIR + "/codepath_cache.sqlite"
+# Most shards assimilate_data_incremental has open at once
+MERGE_FAN_IN = 64
+# Bumped whenever the chunks in the shards are written differently
+SHARD_VERSION = 2
+
+STAGE_TIMES = []
+
+@contextmanager
+def timed_stage(name):
+    start = time.time()
+    yield
+    STAGE_TIMES.append((name, time.time() - start))
+
+def print_stage_times():
+    print("---- Timing Summary ----")
+    for name, seconds in STAGE_TIMES:
+        print("{:<24} {:10.1f}s".format(name, seconds))
+    print("{:<24} {:10.1f}s".format("TOTAL", sum(t for _, t in STAGE_TIMES)))
 
 def to_quickload(data):
     new_data = []
@@ -57,26 +87,34 @@ def tok_code_vocab_files(data, name, subname):
     voc2idx_tv, voc2count_tv = preprocessed.load_vocab(name, subname+'_tvs')
 
     for d in data:
-        names = list(set(d["target_var_string"]))
-        name_dict = {n:i for i,n in enumerate(names)}
-        d['path_idx'] = [voc2idx_path[p] if p in voc2idx_path else 0 for p in d["path_strings"] ]
-        d['target_var_idx'] = [voc2idx_tv[p] if p in voc2idx_tv else 0 for p in d["target_var_string"]]
-        d['target_var_mask_idx'] = [name_dict[p] for p in d["target_var_string"]]
-        d['target_var_mask_names'] = names
+        index_codepaths(d, voc2idx_path, voc2idx_tv)
     return data
 
-def save_quickload_version(data, name, test_percentage):
+def codepath_lookup(data):
+    '''Extract the code paths of every record in data once. Returns a map from
+    id(record) to its populated copy, for records that have code paths.'''
+    populated = populate_codepath_index(data)
+    return {id(data[i]): d for i, d in populated.items()}
+
+def save_quickload_version(data, name, test_percentage, codepaths=None):
+    '''Save the code2vec version of a data set. `codepaths` is an optional
+    lookup from `codepath_lookup`, to reuse paths already extracted.'''
     do_split = (len(data) == 1)
 
+    if codepaths is None:
+        populate = return_populated_codepath
+    else:
+        populate = lambda ds: [codepaths[id(d)] for d in ds if id(d) in codepaths]
+
     if do_split:
-        data = return_populated_codepath(data[0])
+        data = populate(data[0])
         n = len(data)
         test = data[:int(n * test_percentage)]
         train = data[int(n * test_percentage):]
     else:
         assert len(data) == 2
-        train = return_populated_codepath(data[0])
-        test = return_populated_codepath(data[1])
+        train = populate(data[0])
+        test = populate(data[1])
 
     gen_code_vocab_files(train, name, "quickload")
     train = to_quickload(tok_code_vocab_files(train, name, "quickload"))
@@ -109,6 +147,31 @@ def _ad_hoc_clean(filename, line):
     return line
 
 
+def _load_raw_yaml(t, yaml_file):
+    with open(RAWDATADIR + "/{}/{}".format(t, yaml_file), "r", encoding='utf-8') as f:
+        string = ''.join([_ad_hoc_clean(yaml_file, l)
+                            for l in f.readlines()])
+    return yaml.load(string.replace(
+        "            desc: `", "            desc: \\`").replace(
+        "            type: `", "            type: \\`"), Loader=CLoader)
+
+
+def _count_args(data):
+    '''Return the number of args with descriptions and the total number of args'''
+    args, tot_args = 0, 0
+    for d in data.values():
+        args += len([k for k, v in d["arg_info"].items() if v['desc']])
+        tot_args += len(d["args"])
+    return args, tot_args
+
+
+def _dump_records(data):
+    '''The assimilated yaml of data. No vertical spacing, which pyaml adds
+    depending on the whole document, so that the yaml of a dict is the yaml of
+    each of its (sorted) keys concatenated.'''
+    return pyaml.dump(data, vspacing=None)
+
+
 def assimilate_data():
     '''Clean and assimilate data into big yaml files (not necessarily human readable)'''
     types = ['full', 'short']
@@ -119,36 +182,29 @@ def assimilate_data():
         for i, yaml_file in enumerate(os.listdir(RAWDATADIR + "/" + t + "/")):
             if yaml_file == 'error.yaml':
                 continue
-            with open(RAWDATADIR + "/{}/{}".format(t, yaml_file), "r", encoding='utf-8') as f:
-                string = ''.join([_ad_hoc_clean(yaml_file, l)
-                                    for l in f.readlines()])
-                data = yaml.load(string.replace(
-                    "            desc: `", "            desc: \\`").replace(
-                    "            type: `", "            type: \\`"), Loader=CLoader)
-
-                print("{}: {} To Update: {} ".format(
-                    i, yaml_file, len(data.keys())))
-                tot = len(all_data.keys())
-                all_data.update(data)
-                print("{}: {} Updated: {} ".format(
-                    i, yaml_file, len(all_data.keys()) - tot))
-
-                args = 0
-                for d in data.values():
-                    args += len([k for k, v in d["arg_info"].items() if v['desc']])
-                    tot_args += len(d["args"])
-
-                tot_f += len(data)
-                all_files[yaml_file] = {
-                    "funcs": len(data),
-                    "args": args
-                }
+            data = _load_raw_yaml(t, yaml_file)
+
+            print("{}: {} To Update: {} ".format(
+                i, yaml_file, len(data.keys())))
+            tot = len(all_data.keys())
+            all_data.update(data)
+            print("{}: {} Updated: {} ".format(
+                i, yaml_file, len(all_data.keys()) - tot))
+
+            args, file_args = _count_args(data)
+            tot_args += file_args
+
+            tot_f += len(data)
+            all_files[yaml_file] = {
+                "funcs": len(data),
+                "args": args
+            }
 
         with open(PREPROCESSDATADIR+"/index.txt", "w", encoding='utf-8') as f:
             all_files["TOTAL__"] = {"funcs": tot_f, "args": tot_args}
             f.write(pyaml.dump(all_files))
         with open(PREPROCESSDATADIR+"/all_{}.yaml".format(t), "w", encoding='utf-8') as f:
-            f.write(pyaml.dump(all_data))#, Dumper=CDumper))
+            f.write(_dump_records(all_data))
 
     for t in types:
         print("Assimilated, now test loading...")
@@ -158,8 +214,208 @@ def assimilate_data():
     return all_files
 
 
+def _file_hash(filename):
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _write_shard(filename, data):
+    '''Save a raw file's records as a stream of (key, yaml chunk) pairs, sorted by key'''
+    with open(filename, 'wb') as f:
+        for k in sorted(data, key=str):
+            pickle.dump((k, _dump_records({k: data[k]})), f)
+
+
+def _read_shard(filename):
+    with open(filename, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+def _read_owned(filename, yaml_file, owner):
+    '''The chunks of a shard that are not overridden by a later raw file'''
+    return ((k, chunk) for k, chunk in _read_shard(filename) if owner[k] == yaml_file)
+
+
+def _shard_key(item):
+    return str(item[0])
+
+
+def _merge_shards(sources, tmp_dir, fan_in):
+    '''Merge sorted streams of (key, chunk), given as functions that open them,
+    with at most fan_in files open at once: while there are more, groups of
+    fan_in are merged into intermediate shards in tmp_dir first.'''
+    level, intermediate = 0, []
+    while len(sources) > fan_in:
+        merged = []
+        for start in range(0, len(sources), fan_in):
+            filename = "{}/merge_{}_{}.pkl".format(tmp_dir, level, start // fan_in)
+            with open(filename, 'wb') as f:
+                for item in heapq.merge(*[s() for s in sources[start:start + fan_in]], key=_shard_key):
+                    pickle.dump(item, f)
+            merged.append(filename)
+        for filename in intermediate:
+            os.remove(filename)
+        sources = [partial(_read_shard, filename) for filename in merged]
+        level, intermediate = level + 1, merged
+    return heapq.merge(*[s() for s in sources], key=_shard_key)
+
+
+def assimilate_data_incremental(verify=False):
+    '''Assimilate data like `assimilate_data`, but only re-parse raw files whose
+    content hash changed since the last run. Every raw file is kept as a
+    sorted shard of yaml chunks, which are merged and streamed into the
+    assimilated yaml, so the full corpus is never held in memory. The output
+    is the same as that of `assimilate_data`.'''
+    types = ['full', 'short']
+    for t in types:
+        manifest_file = PREPROCESSDATADIR + "/assimilate_manifest_{}.yaml".format(t)
+        shard_dir = PREPROCESSDATADIR + "/assimilated/{}".format(t)
+        if not os.path.exists(shard_dir):
+            os.makedirs(shard_dir)
+
+        manifest = {}
+        if os.path.isfile(manifest_file):
+            with open(manifest_file, "r", encoding='utf-8') as f:
+                manifest = yaml.load(f, Loader=CLoader) or {}
+
+        yaml_files = [y for y in os.listdir(RAWDATADIR + "/" + t + "/") if y != 'error.yaml']
+        new_manifest = {}
+        for i, yaml_file in enumerate(yaml_files):
+            shard = "{}/{}.pkl".format(shard_dir, yaml_file)
+            file_hash = _file_hash(RAWDATADIR + "/{}/{}".format(t, yaml_file))
+            entry = manifest.get(yaml_file)
+            if entry is not None and entry["hash"] == file_hash and \
+                    entry.get("version") == SHARD_VERSION and os.path.isfile(shard):
+                new_manifest[yaml_file] = entry
+                print("{}: {} Unchanged: {} ".format(i, yaml_file, entry["funcs"]))
+                continue
+
+            data = _load_raw_yaml(t, yaml_file)
+            _write_shard(shard, data)
+            args, file_args = _count_args(data)
+            new_manifest[yaml_file] = {
+                "hash": file_hash,
+                "version": SHARD_VERSION,
+                "funcs": len(data),
+                "args": args,
+                "all_args": file_args,
+                "keys": sorted(data, key=str)
+            }
+            print("{}: {} Parsed: {} ".format(i, yaml_file, len(data)))
+
+        for yaml_file in set(manifest) - set(new_manifest):
+            shard = "{}/{}.pkl".format(shard_dir, yaml_file)
+            if os.path.isfile(shard):
+                os.remove(shard)
+
+        # Later files override earlier ones, as with dict.update
+        owner = {}
+        for yaml_file in yaml_files:
+            for k in new_manifest[yaml_file]["keys"]:
+                owner[k] = yaml_file
+
+        shards = [partial(_read_owned, "{}/{}.pkl".format(shard_dir, y), y, owner) for y in yaml_files]
+        merge_dir = shard_dir + ".merge"
+        if os.path.exists(merge_dir):
+            shutil.rmtree(merge_dir)
+        os.makedirs(merge_dir)
+        all_file = PREPROCESSDATADIR+"/all_{}.yaml".format(t)
+        with open(all_file + ".tmp", "w", encoding='utf-8') as f:
+            if not owner:
+                f.write(_dump_records({}))
+            for k, chunk in _merge_shards(shards, merge_dir, MERGE_FAN_IN):
+                f.write(chunk)
+        os.replace(all_file + ".tmp", all_file)
+        shutil.rmtree(merge_dir)
+        print("Assimilated {}: {} records".format(t, len(owner)))
+
+        all_files = {y: {"funcs": new_manifest[y]["funcs"], "args": new_manifest[y]["args"]}
+                     for y in yaml_files}
+        all_files["TOTAL__"] = {"funcs": sum(new_manifest[y]["funcs"] for y in yaml_files),
+                                "args": sum(new_manifest[y]["all_args"] for y in yaml_files)}
+        with open(PREPROCESSDATADIR+"/index.txt", "w", encoding='utf-8') as f:
+            f.write(pyaml.dump(all_files))
+        with open(manifest_file, "w", encoding='utf-8') as f:
+            f.write(yaml.dump(new_manifest, Dumper=CDumper))
+
+    if verify:
+        for t in types:
+            print("Assimilated, now test loading...")
+            with open(PREPROCESSDATADIR+"/all_{}.yaml".format(t), "r", encoding='utf-8') as f:
+                data = yaml.load(f, Loader=CLoader)
+                print("loaded {}: {} records".format(t, len(data)))
+    return all_files
+
+
+class ArgRecord(Mapping):
+    '''A documented argument of a function record. Behaves like the dict of
+    the function record extended with arg_name, arg_desc and arg_type (and
+    with the argument removed from arg_info), but only references the shared
+    function record instead of copying it. Fields assigned later are kept
+    on the record itself and never written through to the function.'''
+    __slots__ = ['func', 'arg_name', 'arg_desc', 'arg_type', 'extra']
+
+    OWN_FIELDS = ('arg_name', 'arg_desc', 'arg_type')
+
+    def __init__(self, func, arg_name):
+        self.func = func
+        self.arg_name = arg_name
+        self.arg_desc = func['arg_info'][arg_name]['desc']
+        self.arg_type = func['arg_info'][arg_name]['type']
+        self.extra = None
+
+    def __getitem__(self, key):
+        if key in ArgRecord.OWN_FIELDS:
+            return getattr(self, key)
+        if self.extra is not None and key in self.extra:
+            return self.extra[key]
+        if key == 'arg_info':
+            return {k: v for k, v in self.func['arg_info'].items() if k != self.arg_name}
+        return self.func[key]
+
+    def __setitem__(self, key, value):
+        if key in ArgRecord.OWN_FIELDS:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __iter__(self):
+        for k in self.func:
+            if k not in ArgRecord.OWN_FIELDS:
+                yield k
+        for k in ArgRecord.OWN_FIELDS:
+            yield k
+        if self.extra is not None:
+            for k in self.extra:
+                if k not in self.func:
+                    yield k
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return "ArgRecord({})".format(dict(self))
+
+    def copy(self):
+        record = ArgRecord.__new__(ArgRecord)
+        record.func = self.func
+        record.arg_name = self.arg_name
+        record.arg_desc = self.arg_desc
+        record.arg_type = self.arg_type
+        record.extra = dict(self.extra) if self.extra is not None else None
+        return record
+
+
 def map_yaml_to_arg_list(yaml_object):
-    import copy
     args = []
     count = 0
     desc_count = 0
@@ -168,24 +424,26 @@ def map_yaml_to_arg_list(yaml_object):
             count += 1
             if v['arg_info'][a]['desc']:
                 desc_count += 1
-                data = copy.deepcopy(v)
-                data['arg_name'] = a
-                data['arg_desc'] = v['arg_info'][a]['desc']
-                data['arg_type'] = v['arg_info'][a]['type']
-
-                data['arg_info'].pop(a)
-                args.append(data)
+                args.append(ArgRecord(v, a))
 
     print("Args: ", count, " Args with Desc: ", desc_count)
     return args
 
 
-def prep_main_set(test_percentage):
-    print("starting: prep_main_set")
+def load_arg_table():
+    '''Parse the assimilated yaml once and expand it to one record per documented
+    argument. Every prep_* builder can be driven off this table.'''
     with open(PREPROCESSDATADIR+"/all_full.yaml", "r", encoding='utf-8') as f:
         data = yaml.load(f, Loader=CLoader)
+    return map_yaml_to_arg_list(data)
+
 
-    main_data = map_yaml_to_arg_list(data)
+def prep_main_set(test_percentage, arg_table=None):
+    print("starting: prep_main_set")
+    if arg_table is None:
+        arg_table = load_arg_table()
+
+    main_data = list(arg_table)
     random.shuffle(main_data)
 
     n = len(main_data)
@@ -197,50 +455,55 @@ def prep_main_set(test_percentage):
     save_quickload_version([train_data, test_data], 'unsplit', test_percentage)
 
 
-def prep_no_dups_split(train_data, test_data):
-    for dups in [1,2,3,4,5,10]:
-        dups_str = str(dups) if dups != 10 else 'X'
-        filtered_train_data = []
-        filtered_test_data = []
-        c = Counter()
-        for d in train_data:
-            uniq_pair = d['arg_name']+'|'+ " ".join(nltk_tok(d['arg_desc']))
-            c.update({uniq_pair: 1})
+NO_DUPS = [1, 2, 3, 4, 5, 10]
+
+def _no_dups_str(dups):
+    return str(dups) if dups != 10 else 'X'
+
+def occurrence_ranks(data):
+    '''For every record, how many times its (arg_name, tokenized arg_desc) pair
+    has been seen so far, including itself'''
+    c = Counter()
+    ranks = []
+    all_desc_tok = nltk_tok_batch([d['arg_desc'] for d in data])
+    for d, desc_tok in zip(data, all_desc_tok):
+        uniq_pair = d['arg_name']+'|'+ " ".join(desc_tok)
+        c[uniq_pair] += 1
+        ranks.append(c[uniq_pair])
+    return ranks
 
-            if c[uniq_pair] <= dups:
-                filtered_train_data.append(d)
 
-        for d in test_data:
-            uniq_pair = d['arg_name']+'|'+ " ".join(nltk_tok(d['arg_desc']))
-            c.update({uniq_pair: 1})
+def prep_no_dups_split(train_data, test_data, codepaths=None):
+    ranks = occurrence_ranks(train_data + test_data)
+    train_ranks, test_ranks = ranks[:len(train_data)], ranks[len(train_data):]
+    if codepaths is None:
+        codepaths = codepath_lookup(train_data + test_data)
 
-            if c[uniq_pair] <= dups:
-                filtered_test_data.append(d)
+    for dups in NO_DUPS:
+        dups_str = _no_dups_str(dups)
+        filtered_train_data = [d for d, r in zip(train_data, train_ranks) if r <= dups]
+        filtered_test_data = [d for d, r in zip(test_data, test_ranks) if r <= dups]
 
         frac = len(filtered_test_data)/(len(filtered_train_data) + len(filtered_test_data))
         print("Split No Dups{}: Train: {} Test and Valid: {},  Fraction:{}".format(
             dups_str, len(filtered_train_data), len(filtered_test_data), frac))
         preprocessed.save_data(filtered_train_data, filtered_test_data, 'no_dups_split_{}'.format(dups_str))
-        save_quickload_version([filtered_train_data, filtered_test_data], 'no_dups_split_{}'.format(dups_str), 0.0)
+        save_quickload_version([filtered_train_data, filtered_test_data], 'no_dups_split_{}'.format(dups_str), 0.0,
+                               codepaths)
 
 
-def prep_no_duplicates(test_percentage):
+def prep_no_duplicates(test_percentage, arg_table=None):
     print("starting: prep_no_duplicates")
-    with open(PREPROCESSDATADIR+"/all_full.yaml", "r", encoding='utf-8') as f:
-        data = yaml.load(f, Loader=CLoader)
+    if arg_table is None:
+        arg_table = load_arg_table()
 
-    main_data = map_yaml_to_arg_list(data)
+    main_data = list(arg_table)
     random.shuffle(main_data)
-    for dups in [1,2,3,4,5,10]:
-        dups_str = str(dups) if dups != 10 else 'X'
-        filtered_data = []
-        c = Counter()
-        for d in main_data:
-            uniq_pair = d['arg_name']+'|'+ " ".join(nltk_tok(d['arg_desc']))
-            c.update({uniq_pair: 1})
-
-            if c[uniq_pair] <= dups:
-                filtered_data.append(d)
+    ranks = occurrence_ranks(main_data)
+    codepaths = codepath_lookup(main_data)
+    for dups in NO_DUPS:
+        dups_str = _no_dups_str(dups)
+        filtered_data = [d for d, r in zip(main_data, ranks) if r <= dups]
 
         n = len(filtered_data)
         print("Total Data Size for NoDup{}: {}".format(dups_str, n))
@@ -249,20 +512,15 @@ def prep_no_duplicates(test_percentage):
 
 
         preprocessed.save_data(train_data, test_data, 'no_dups_{}'.format(dups_str))
-        save_quickload_version([filtered_data], 'no_dups_{}'.format(dups_str), test_percentage)
+        save_quickload_version([filtered_data], 'no_dups_{}'.format(dups_str), test_percentage, codepaths)
 
-def prep_overfit_set(test_percentage):
+def prep_overfit_set(test_percentage, arg_table=None):
     '''Prepare a tiny dataset from the raw data, to test overfit.'''
     print("starting: prep_overfit_set")
-    with open(PREPROCESSDATADIR+"/all_full.yaml", "r", encoding='utf-8') as f:
-        data = yaml.load(f, Loader=CLoader)
+    if arg_table is None:
+        arg_table = load_arg_table()
 
-    overfit_set = {}
-    for k, v in data.items():
-        if v['filename'].startswith("/numpy/"):
-            overfit_set[k] = v
-
-    overfit_data = map_yaml_to_arg_list(overfit_set)
+    overfit_data = [d for d in arg_table if d['filename'].startswith("/numpy/")]
     random.shuffle(overfit_data)
 
     n = len(overfit_data)
@@ -273,7 +531,7 @@ def prep_overfit_set(test_percentage):
     preprocessed.save_data(train, test, 'overfit')
     save_quickload_version([overfit_data], 'overfit', test_percentage)
 
-def prep_repo_split_set(test_percentage):
+def prep_repo_split_set(test_percentage, arg_table=None):
     '''Prepare a data set with training and test data from different repositories'''
     print("starting: prep_repo_split_set")
     with open(PREPROCESSDATADIR + "/index.txt", "r", encoding='utf-8') as f:
@@ -296,19 +554,11 @@ def prep_repo_split_set(test_percentage):
         if count > test_set_size:
             break
 
-    with open(PREPROCESSDATADIR+"/all_full.yaml", "r", encoding='utf-8') as f:
-        data = yaml.load(f, Loader=CLoader)
+    if arg_table is None:
+        arg_table = load_arg_table()
 
-    test_set = {}
-    train_set = {}
-    for k, v in data.items():
-        if v['pkg'] in test_repos:
-            test_set[k] = v
-        else:
-            train_set[k] = v
-
-    train_data = map_yaml_to_arg_list(train_set)
-    test_data = map_yaml_to_arg_list(test_set)
+    test_data = [d for d in arg_table if d['pkg'] in test_repos]
+    train_data = [d for d in arg_table if d['pkg'] not in test_repos]
 
     random.shuffle(train_data)
     random.shuffle(test_data)
@@ -318,10 +568,11 @@ def prep_repo_split_set(test_percentage):
     print("Test Fraction: {:4f}".format(
         len(test_data)/(len(test_data) + len(train_data))))
 
+    codepaths = codepath_lookup(train_data + test_data)
     preprocessed.save_data(train_data, test_data, 'split')
-    save_quickload_version([train_data, test_data], 'split', test_percentage)
+    save_quickload_version([train_data, test_data], 'split', test_percentage, codepaths)
 
-    prep_no_dups_split(train_data, test_data)
+    prep_no_dups_split(train_data, test_data, codepaths)
 
 
 
@@ -330,6 +581,8 @@ def _build_argparser():
         description='Preprocess your raw Bonaparte data into formats that can be used')
     parser.add_argument('--assimilate', '-a', dest='assimilate', action='store_true',
                         default=False, help='collect all individual yaml files and assimilate into master yaml (must be fone before prepping data sets)')
+    parser.add_argument('--incremental', '-i', dest='incremental', action='store_true',
+                        default=False, help='when assimilating, only re-parse raw yaml files that changed since the last run')
     parser.add_argument('--prep_overfit', '-o', dest='overfit_set', action='store_true',
                         default=False, help='prepare an overfit dataset from the assimilated yaml')
     parser.add_argument('--prep_combined_repos', '-c', dest='unsplit_set', action='store_true',
@@ -340,6 +593,12 @@ def _build_argparser():
                         default=False, help='prepare data sets with train and test without duplicates of (name, desc) pairs')
     parser.add_argument('--run-all', '-r', dest='run_all', action='store_true',
                         default=False, help='assimilate and prep both main and overfit datasets')
+    parser.add_argument('--to-columnar', '-k', dest='to_columnar', action='store_true',
+                        default=False, help='convert existing yaml train/valid/test splits into the columnar format')
+    parser.add_argument('--max-paths-per-var', '-p', dest='max_paths_per_var', action='store',
+                        type=int, default=None, help='keep at most this many (sampled) code paths to each target variable')
+    parser.add_argument('--no-codepath-cache', '-n', dest='codepath_cache', action='store_false',
+                        default=True, help='extract every code path again instead of reusing the ones cached from earlier runs')
 
     return parser
 
@@ -349,22 +608,39 @@ def _build_argparser():
 if __name__ == "__main__":
     parser = _build_argparser()
     args = parser.parse_args()
+    assimilate = assimilate_data_incremental if args.incremental else assimilate_data
+    code_tokenize.MAX_PATHS_PER_VAR = args.max_paths_per_var
+    if args.codepath_cache:
+        code_tokenize.CODEPATH_CACHE = code_tokenize.CodePathCache(CODEPATH_CACHE_FILE)
     if args.run_all:
-        assimilate_data()
-        prep_main_set(0.3)
-        prep_overfit_set(0.3)
-        prep_repo_split_set(0.25)
-        prep_no_duplicates(0.3)
-    else:
-        if args.assimilate:
-            assimilate_data()
-        if args.unsplit_set:
-            prep_main_set(0.3)
-        if args.overfit_set:
-            prep_overfit_set(0.3)
-        if args.sep_repos:
-            prep_repo_split_set(0.25)
-        if args.no_dups:
-            prep_no_duplicates(0.3)
-    if not any(vars(args).values()):
+        args.assimilate = args.unsplit_set = args.overfit_set = True
+        args.sep_repos = args.no_dups = True
+
+    if args.assimilate:
+        with timed_stage("assimilate"):
+            assimilate()
+
+    builders = [(args.unsplit_set, "prep_main_set", prep_main_set, 0.3),
+                (args.overfit_set, "prep_overfit_set", prep_overfit_set, 0.3),
+                (args.sep_repos, "prep_repo_split_set", prep_repo_split_set, 0.25),
+                (args.no_dups, "prep_no_duplicates", prep_no_duplicates, 0.3)]
+    if any(b[0] for b in builders):
+        with timed_stage("load_arg_table"):
+            arg_table = load_arg_table()
+        for selected, name, builder, test_percentage in builders:
+            if selected:
+                with timed_stage(name):
+                    builder(test_percentage, arg_table)
+
+    if args.to_columnar:
+        with timed_stage("to_columnar"):
+            preprocessed.convert_to_columnar()
+
+    if not any(v for k, v in vars(args).items() if k not in ('max_paths_per_var', 'codepath_cache')):
         parser.print_help()
+    else:
+        print_stage_times()
+
+    if code_tokenize.CODEPATH_CACHE is not None:
+        print(code_tokenize.CODEPATH_CACHE.summary())
+        code_tokenize.CODEPATH_CACHE.close()
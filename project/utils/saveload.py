@@ -55,6 +55,12 @@ def load(session, logpath):
         SAVER = tf.train.Saver(max_to_keep=5)
     return SAVER.restore(session, ckpt), int(iteration)
 
+def restore(session, ckpt):
+    global SAVER
+    if SAVER is None or SAVER == -1:
+        SAVER = tf.train.Saver(max_to_keep=5)
+    return SAVER.restore(session, ckpt)
+
 def backup_for_later(logpath, model, directory):
     dest_dir = '{}/{}/'.format(logpath, directory)
     if os.path.exists(dest_dir):
@@ -63,6 +69,26 @@ def backup_for_later(logpath, model, directory):
     for filename in glob.glob(r'{}*'.format( model)):
         shutil.copy(filename, dest_dir)
 
+def snapshot_checkpoint(ckpt, directory):
+    '''Hard link (or copy) the files of checkpoint ckpt into directory, so that
+    it can still be restored after the Saver rotates ckpt out. Returns the
+    checkpoint path in directory; raises FileNotFoundError if ckpt is gone.'''
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.mkdir(directory)
+    filenames = glob.glob('{}.*'.format(ckpt))
+    if not filenames:
+        raise FileNotFoundError(ckpt)
+    for filename in filenames:
+        dest = os.path.join(directory, os.path.basename(filename))
+        try:
+            os.link(filename, dest)
+        except FileNotFoundError:
+            raise
+        except OSError:
+            shutil.copy(filename, dest)
+    return os.path.join(directory, os.path.basename(ckpt))
+
 def setup_saver(max_saves):
     global SAVER
 
@@ -1,11 +1,20 @@
 from collections import namedtuple, Counter, defaultdict
+from itertools import chain
+import atexit
+import hashlib
+from multiprocessing import Pool, cpu_count
 import os
+import pickle
+import sqlite3
+import threading
 
 from nltk import word_tokenize
 import numpy as np
 from tqdm import tqdm
 
+from project.data import preprocessed
 from project.data.preprocessed import DataTuple, load_vocab
+from project.utils.batching import RaggedTensor, pad_rows
 
 PAD_TOKEN = '<PAD>'
 UNKNOWN_TOKEN = '<UNK>'
@@ -82,35 +91,85 @@ def get_embed_filenames():
         300: "{}/glove/glove.6B.300d.txt".format(DIR),
     }
 
-def gen_train_vocab(train_data, embed_file, vocab_size):
-    all_toks = []
-    for d in train_data:
-        all_toks.extend(nltk_tok(d['arg_desc']))
-    most_common = Counter(all_toks).most_common()
+def convert_glove(embed_file):
+    '''One-time conversion of a GloVe text file into a float32 matrix
+    (`embed_file`.npy) and its word list, one word per row (`embed_file`.vocab)'''
+    n, dim = 0, None
+    with open(embed_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            if dim is None:
+                dim = len(line.split()) - 1
+            n += 1
+
+    words = []
+    matrix = np.lib.format.open_memmap(
+        embed_file + ".npy.tmp", mode='w+', dtype=np.float32, shape=(n, dim))
+    with open(embed_file, 'r', encoding='utf-8') as f:
+        for i, line in enumerate(tqdm(f, total=n)):
+            values = line.split()
+            words.append(values[0])
+            matrix[i] = np.array(values[1:]).astype(np.float32)
+    matrix.flush()
+    del matrix
+    os.replace(embed_file + ".npy.tmp", embed_file + ".npy")
 
-    vocab = []
-    if os.path.isfile(embed_file + ".vocab"):
-        with open(embed_file + ".vocab", 'r', encoding='utf-8') as f:
-            file_voc = [line.strip() for line in f]
+    with open(embed_file + ".vocab", 'w', encoding='utf-8') as f:
+        f.write("\n".join(words))
+
+
+def load_glove_vocab(embed_file):
+    if not os.path.isfile(embed_file + ".vocab"):
+        convert_glove(embed_file)
+    with open(embed_file + ".vocab", 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f]
+
+
+def load_glove(embed_file):
+    '''Return the GloVe word list and a memory mapped [words x dim] matrix'''
+    if not os.path.isfile(embed_file + ".npy"):
+        convert_glove(embed_file)
+    return load_glove_vocab(embed_file), np.load(embed_file + ".npy", mmap_mode='r')
 
-    else:
-        with open(embed_file, 'r', encoding='utf-8') as f:
-            file_voc = [ line.split()[0] for line in f ]
-        with open(embed_file + ".vocab", 'w', encoding='utf-8') as f:
-            f.write("\n".join(file_voc))
 
-    for tok, count in most_common:
+def build_vocab(common_tokens, file_voc, vocab_size, min_count, vocab=None):
+    '''Choose a vocab: first the tokens (in order of frequency) that occur more
+    than min_count times and are in file_voc, until there are more than
+    vocab_size, then fill up to vocab_size with the remaining file_voc words
+    in file order. `vocab` is an optional list of tokens to start from.'''
+    vocab = list(vocab) if vocab is not None else []
+    available = set(file_voc)
+    chosen = set()
+    for tok, count in common_tokens:
 
-        if tok in file_voc and count > 4:
+        if count > min_count and tok in available and tok not in chosen:
             vocab.append(tok)
-            file_voc.remove(tok)
+            chosen.add(tok)
 
         if len(vocab) > vocab_size:
             break
 
     if len(vocab) < vocab_size:
-        vocab.extend(file_voc[:vocab_size - len(vocab)])
-    return set(vocab)
+        needed = vocab_size - len(vocab)
+        skip = set(chosen)  # only the first occurrence of a chosen word is used up
+        for tok in file_voc:
+            if needed <= 0:
+                break
+            if tok in skip:
+                skip.discard(tok)
+                continue
+            vocab.append(tok)
+            needed -= 1
+    return vocab
+
+
+def gen_train_vocab(train_data, embed_file, vocab_size, min_count=4):
+    all_toks = []
+    for toks in nltk_tok_batch([d['arg_desc'] for d in train_data]):
+        all_toks.extend(toks)
+    most_common = Counter(all_toks).most_common()
+
+    file_voc = load_glove_vocab(embed_file)
+    return set(build_vocab(most_common, file_voc, vocab_size, min_count))
 
 
 def get_weights_word2idx(desc_embed, vocab_size=100000, train_data=None):
@@ -118,50 +177,150 @@ def get_weights_word2idx(desc_embed, vocab_size=100000, train_data=None):
     embed_files = get_embed_filenames()
     embed_file = embed_files[desc_embed]
 
+    desired_vocab = None
     if train_data is not None:
         desired_vocab = gen_train_vocab(train_data, embed_file, vocab_size)
 
 
     word2idx = {PAD_TOKEN: 0}
-    weights = [np.random.randn(desc_embed)]
+    pad_weights = np.random.randn(desc_embed)
 
+    glove_words, glove_weights = load_glove(embed_file)
+    rows = []
+    for row, word in enumerate(glove_words):
+        if desired_vocab is None or word in desired_vocab:
+            word2idx[word] = len(rows) + 1
+            rows.append(row)
 
-    with open(embed_file, "r", encoding='utf-8') as f:
-        i = 0
-        for line in tqdm(f):
-            values = line.split()
+            if len(rows) > vocab_size:
+                break
 
-            word = values[0]
-            if word in desired_vocab:
-                word_weights = np.array(values[1:]).astype(np.float32)
+    n = len(rows) + 1
+    weights = np.empty([n + 3, desc_embed], dtype=np.float32)
+    weights[0] = pad_weights
+    weights[1:n] = glove_weights[rows]
 
-                word2idx[word] = i + 1
-                weights.append(word_weights)
+    word2idx[UNKNOWN_TOKEN] = n
+    weights[n] = np.random.randn(desc_embed)
 
-                i += 1
+    word2idx[START_OF_TEXT_TOKEN] = n + 1
+    weights[n + 1] = np.random.randn(desc_embed)
 
-            if i > vocab_size:
-                break
+    word2idx[END_OF_TEXT_TOKEN] = n + 2
+    weights[n + 2] = np.random.randn(desc_embed)
 
-    word2idx[UNKNOWN_TOKEN] = len(weights)
-    weights.append(np.random.randn(desc_embed))
+    return (weights, word2idx)
 
-    word2idx[START_OF_TEXT_TOKEN] = len(weights)
-    weights.append(np.random.randn(desc_embed))
+def _nltk_tok(desc):
+    return word_tokenize(desc.replace('\\n', " ").lower())
 
-    word2idx[END_OF_TEXT_TOKEN] = len(weights)
-    weights.append(np.random.randn(desc_embed))
 
-    weights = np.asarray(weights, dtype=np.float32)
-    return (weights, word2idx)
+class TokenCache(object):
+    '''Persistent, content addressed cache of nltk tokenisations: maps the sha1
+    of a string to its token list, in an sqlite database. Only the entries
+    looked up are read, and new ones are appended; they are committed after
+    every batch and by `save`, which also runs at exit. The database is only
+    opened on first use.'''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._save_at_exit = False
+
+    @staticmethod
+    def key(string):
+        return hashlib.sha1(string.encode('utf-8', 'surrogatepass')).digest()
+
+    @property
+    def conn(self):
+        # A connection is not shared with forked processes
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.filename, check_same_thread=False)
+            self._conn.execute("CREATE TABLE IF NOT EXISTS tokens (key BLOB PRIMARY KEY, tokens BLOB)")
+            self._pid = os.getpid()
+            if not self._save_at_exit:
+                atexit.register(self.save)
+                self._save_at_exit = True
+        return self._conn
+
+    def _get_many(self, keys, batch_size=500):
+        keys = list(keys)
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), batch_size):
+                batch = keys[start:start + batch_size]
+                rows = self.conn.execute("SELECT key, tokens FROM tokens WHERE key IN ({})".format(
+                    ",".join("?" * len(batch))), batch)
+                found.update((k, pickle.loads(v)) for k, v in rows)
+        return found
+
+    def _put_many(self, items, commit=True):
+        with self._lock:
+            self.conn.executemany("INSERT OR REPLACE INTO tokens VALUES (?, ?)",
+                                  ((k, pickle.dumps(v, pickle.HIGHEST_PROTOCOL)) for k, v in items))
+            if commit:
+                self.conn.commit()
+
+    def tokenize(self, string):
+        k = self.key(string)
+        found = self._get_many([k])
+        if k not in found:
+            found[k] = _nltk_tok(string)
+            self._put_many(found.items(), commit=False)
+        return list(found[k])
+
+    def tokenize_batch(self, strings, processes=None):
+        '''Tokenize many strings at once, spreading the uncached ones over a
+        process pool'''
+        keys = [self.key(s) for s in strings]
+        found = self._get_many(set(keys))
+        missing = {}
+        for k, s in zip(keys, strings):
+            if k not in found and k not in missing:
+                missing[k] = s
+
+        if missing:
+            processes = processes or max(1, min(20, cpu_count() - 1))
+            if processes > 1 and len(missing) > 1000:
+                with Pool(processes) as pool:
+                    tokens = pool.map(_nltk_tok, missing.values(), chunksize=1000)
+            else:
+                tokens = [_nltk_tok(s) for s in missing.values()]
+            new = dict(zip(missing.keys(), tokens))
+            self._put_many(new.items())
+            found.update(new)
+        return [list(found[k]) for k in keys]
+
+    def save(self):
+        if self._conn is not None and self._pid == os.getpid():
+            with self._lock:
+                self._conn.commit()
+
+
+PREPROCESSED_DIR = os.path.dirname(os.path.abspath(preprocessed.__file__))
+DESC_TOKEN_CACHE = TokenCache("{}/desc_tokens.sqlite".format(PREPROCESSED_DIR))
+SRC_TOKEN_CACHE = TokenCache("{}/src_tokens.sqlite".format(PREPROCESSED_DIR))
+
+
+def nltk_tok(desc, cache=DESC_TOKEN_CACHE):
+    return cache.tokenize(desc)
+
+
+def nltk_tok_batch(descs, cache=DESC_TOKEN_CACHE):
+    return cache.tokenize_batch(descs)
 
-def nltk_tok(desc):
-    return word_tokenize(desc.replace('\\n', " ").lower())
 
+def _tokenize_descriptions(data):
+    '''Tokenize all descriptions in one batch'''
+    return nltk_tok_batch([d['arg_desc'] for d in data])
 
-def fill_descriptions_tok(d, word2idx):
+
+def fill_descriptions_tok(d, word2idx, desc_tok=None):
     unk_token = word2idx[UNKNOWN_TOKEN]
-    desc_tok = nltk_tok(d['arg_desc'])
+    if desc_tok is None:
+        desc_tok = nltk_tok(d['arg_desc'])
     d['arg_desc_translate'] = desc_tok
 
     d['arg_desc_tokens'] = [START_OF_TEXT_TOKEN]
@@ -247,29 +406,33 @@ def fill_name_funcname_other_args_tok(d, char2idx):
 
 
 def tokenize_vars_funcname_and_descriptions(data, word2idx, char2idx):
-    for i, d in enumerate(data):
-        fill_descriptions_tok(d, word2idx)
+    all_desc_tok = _tokenize_descriptions(data)
+    for d, desc_tok in zip(data, all_desc_tok):
+        fill_descriptions_tok(d, word2idx, desc_tok)
         fill_name_funcname_tok(d, char2idx)
     return data
 
 
 def tokenize_vars_and_descriptions(data, word2idx, char2idx):
-    for i, d in enumerate(data):
-        fill_descriptions_tok(d, word2idx)
+    all_desc_tok = _tokenize_descriptions(data)
+    for d, desc_tok in zip(data, all_desc_tok):
+        fill_descriptions_tok(d, word2idx, desc_tok)
         fill_name_tok(d, char2idx)
     return data
 
 
 def tokenize_vars_other_args_and_descriptions(data, word2idx, char2idx):
-    for i, d in enumerate(data):
-        fill_descriptions_tok(d, word2idx)
+    all_desc_tok = _tokenize_descriptions(data)
+    for d, desc_tok in zip(data, all_desc_tok):
+        fill_descriptions_tok(d, word2idx, desc_tok)
         fill_name_other_args_tok(d, char2idx)
     return data
 
 
 def tokenize_vars_funcname_other_args_and_descriptions(data, word2idx, char2idx):
-    for i, d in enumerate(data):
-        fill_descriptions_tok(d, word2idx)
+    all_desc_tok = _tokenize_descriptions(data)
+    for d, desc_tok in zip(data, all_desc_tok):
+        fill_descriptions_tok(d, word2idx, desc_tok)
         fill_name_funcname_other_args_tok(d, char2idx)
     return data
 
@@ -326,8 +489,8 @@ def tokenize_code2vec_mask_all(data, path_vocab, **kwargs):
 
 def get_src_vocab(train_data, vocab_size):
     tok = []
-    for d in train_data:
-        tok.extend(nltk_tok(d['src']))
+    for src_tok in nltk_tok_batch([d['src'] for d in train_data], cache=SRC_TOKEN_CACHE):
+        tok.extend(src_tok)
 
     vocab = [UNKNOWN_TOKEN, SEPARATOR_1, SEPARATOR_2]
     vocab.extend([w for w, c in Counter(tok).most_common()[:vocab_size] if c > 4])
@@ -344,9 +507,9 @@ def tokenize_src_to_neighbouring_tokens(data, word2idx, **kwargs):
         SRC_VOCAB = get_src_vocab(data, vocab_size)
     vocab2idx = {k:i for i,k in enumerate(SRC_VOCAB)}
 
-    for i, d in enumerate(data):
+    all_src_tok = nltk_tok_batch([d['src'] for d in data], cache=SRC_TOKEN_CACHE)
+    for i, (d, src_tok) in enumerate(zip(data, all_src_tok)):
         unk_token = vocab2idx[UNKNOWN_TOKEN]
-        src_tok = nltk_tok(d['src'])
         indices = [i for i, k in enumerate(src_tok) if k == d['arg_name']]
 
         sequence = []
@@ -362,9 +525,9 @@ def tokenize_src_to_neighbouring_tokens(data, word2idx, **kwargs):
     return data
 
 def tokenize_src_all_basic_tokens(data, word2idx, **kwargs):
-    for i, d in enumerate(data):
+    all_src_tok = nltk_tok_batch([d['src'] for d in data], cache=SRC_TOKEN_CACHE)
+    for i, (d, src_tok) in enumerate(zip(data, all_src_tok)):
         unk_token = word2idx[UNKNOWN_TOKEN]
-        src_tok = nltk_tok(d['src'])
 
         d['src_tokens'] = [w if w in word2idx else UNKNOWN_TOKEN for w in src_tok]
         d['src_idx'] = [word2idx.get(t, unk_token) for t in src_tok]
@@ -377,27 +540,70 @@ def trim_paths(data, path_seq):
         d['target_var_idx'] = d['target_var_idx'][:path_seq]
     return data
 
-def extract_tensors(data, fields, seq_lengths):
-    tensors = [[] for _ in fields]
-    for d in data:
-        for t, f, s in zip(tensors, fields, seq_lengths):
-            a = np.array(d[f])
-            if len(d[f]) < s:
-                pad = np.pad(a, (0, s + 1 - len(d[f])), 'constant')
-            else:
-                pad = np.pad(a[:s], (0,  1), 'constant')
-            # pad = [d[f][i] if i < len(d[f]) else 0 for i in range(s)]
-            t.append(np.array(pad))
-    return [np.stack(t) for t in tensors]
+def extract_tensor(data, field, seq_length):
+    '''[n, seq_length+1] int32 array of d[field] truncated to seq_length and
+    padded with zeros, so every row ends in at least one PAD.'''
+    lengths = np.fromiter((min(len(d[field]), seq_length) for d in data),
+                          dtype=np.int64, count=len(data))
+    values = np.fromiter(chain.from_iterable(d[field][:seq_length] for d in data),
+                         dtype=np.int32, count=int(lengths.sum()))
+    return pad_rows(values, lengths, seq_length + 1)
+
+def extract_tensors(data, fields, seq_lengths, ragged_fields=()):
+    '''Padded tensors for each field, or RaggedTensors (truncated to the
+    seq_length, but not padded) for the fields in ragged_fields.'''
+    return [RaggedTensor.from_rows((d[f] for d in data), max_len=s) if f in ragged_fields
+            else extract_tensor(data, f, s)
+            for f, s in zip(fields, seq_lengths)]
 
 def extract_transations(data):
     return [d['arg_desc_translate'] for d in data]
 
-def extract_model_data(data, fields, seq_lengths):
-    tensors = extract_tensors(data, fields, seq_lengths)
+def lookup_array(idx2tok):
+    '''The idx2tok dict as a numpy object array, for detokenize.'''
+    lookup = np.empty(max(idx2tok) + 1, dtype=object)
+    for i, t in idx2tok.items():
+        lookup[i] = t
+    return lookup
+
+def detokenize(ids, lookup, skip_first=0, skip_last=0):
+    '''Token lists for every row of a [batch, T] id matrix. Trailing PADs are
+    cut, then skip_first/skip_last tokens are dropped from each end (e.g. the
+    <START> and <END> of a description).'''
+    ids = np.asarray(ids)
+    if ids.ndim != 2 or ids.shape[1] == 0:
+        return [[] for _ in range(len(ids))]
+    nonzero = ids != 0
+    ends = np.where(nonzero.any(axis=1), ids.shape[1] - np.argmax(nonzero[:, ::-1], axis=1), 0) - skip_last
+    tokens = lookup[ids]
+    return [row[skip_first:max(end, skip_first)].tolist() for row, end in zip(tokens, ends)]
+
+def extract_model_data(data, fields, seq_lengths, ragged_fields=()):
+    tensors = extract_tensors(data, fields, seq_lengths, ragged_fields)
     translations = extract_transations(data)
     return tuple(tensors + [translations])
 
+def get_code2vec_dataset_name(use_full_dataset, use_split_dataset, no_dups):
+    '''The name of the dataset get_data_tuple loads, whose quickload path and
+    target var indices were built with the vocabularies saved under it'''
+    if use_full_dataset:
+        if no_dups == 0:
+            name = 'split' if use_split_dataset else 'unsplit'
+        else:
+            name = 'no_dups_split_{}' if use_split_dataset else 'no_dups_{}'
+            name = name.format(no_dups if no_dups != 10 else 'X')
+    else:
+        name = 'overfit'
+    return name
+
+def get_code2vec_vocab(use_full_dataset, use_split_dataset, no_dups):
+    '''(path2idx, target var2idx) the code2vec paths of the dataset get_data_tuple
+    loads are indexed with, to index new code the same way'''
+    name = get_code2vec_dataset_name(use_full_dataset, use_split_dataset, no_dups)
+    path2idx_voc, _ = load_vocab(name, 'quickload_paths')
+    tv2idx_voc, _ = load_vocab(name, 'quickload_tvs')
+    return path2idx_voc, tv2idx_voc
+
 def get_idx2code2vec(use_full_dataset, use_split_dataset, no_dups):
     subname = 'quickload'
     if use_full_dataset:
@@ -508,6 +714,33 @@ def choose_tokenizer(tokenizer):
         tokenize = tokenize_vars_funcname_other_args_and_descriptions
     return tokenize
 
+def choose_name_tokenizer(tokenizer):
+    '''The function filling in arg_name_idx for each tokenizer of choose_tokenizer'''
+    return {
+        'var_only': fill_name_tok,
+        'var_funcname': fill_name_funcname_tok,
+        'var_otherargs': fill_name_other_args_tok,
+        'var_funcname_otherargs': fill_name_funcname_other_args_tok,
+    }[tokenizer]
+
+def get_model_fields(char_seq, desc_seq, code_tokenizer, path_seq=1000, **_):
+    '''The record fields that become the model's input columns, in order,
+    their maximum lengths and which of them are kept ragged.'''
+    fields = ["arg_name_idx", "arg_desc_idx"]
+    seq_lengths = [char_seq, desc_seq]
+    ragged_fields = set()
+
+    if 'code2vec' in code_tokenizer:
+        # Most args have far fewer than path_seq paths: keep them ragged and
+        # pad each minibatch to its own width instead.
+        fields.extend(["path_idx", "target_var_idx"])
+        seq_lengths.extend([path_seq, path_seq])
+        ragged_fields.update(["path_idx", "target_var_idx"])
+    elif code_tokenizer == "full":
+        fields.extend(["src_idx"])
+        seq_lengths.extend([200])
+    return fields, seq_lengths, ragged_fields
+
 def get_embed_tuple_and_data_tuple(vocab_size, char_seq, desc_seq, desc_embed,
                                    use_full_dataset, use_split_dataset, tokenizer,
                                    no_dups, code_tokenizer, path_seq=1000, path_vocab=1000, **_):
@@ -535,20 +768,11 @@ def get_embed_tuple_and_data_tuple(vocab_size, char_seq, desc_seq, desc_embed,
     test_data = code_tokenize(data_tuple.test, word2idx=word2idx, path_vocab=path_vocab)
 
     print("Extracting tensors train and test")
+    fields, seq_lengths, ragged_fields = get_model_fields(char_seq, desc_seq, code_tokenizer, path_seq)
 
-    fields = ["arg_name_idx", "arg_desc_idx"]
-    seq_lengths = [char_seq, desc_seq]
-
-    if 'code2vec' in code_tokenizer:
-        fields.extend(["path_idx", "target_var_idx"])
-        seq_lengths.extend([path_seq, path_seq])
-    elif code_tokenizer == "full":
-        fields.extend(["src_idx"])
-        seq_lengths.extend([200])
-
-    train_data = extract_model_data(train_data, fields, seq_lengths)
-    valid_data = extract_model_data(valid_data, fields, seq_lengths)
-    test_data = extract_model_data(test_data, fields, seq_lengths)
+    train_data = extract_model_data(train_data, fields, seq_lengths, ragged_fields)
+    valid_data = extract_model_data(valid_data, fields, seq_lengths, ragged_fields)
+    test_data = extract_model_data(test_data, fields, seq_lengths, ragged_fields)
 
     return EmbedTuple(word_weights, word2idx, char_weights, char2idx), DataTuple(train_data, valid_data, test_data, "Tensors")
 
@@ -566,5 +790,5 @@ if __name__ == '__main__':
 
 
     char_tensor = data[1].train[3]
-    print(np.max(char_tensor))
+    print(np.max(char_tensor.values))
     print(data[1].train[0].shape)
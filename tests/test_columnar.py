@@ -0,0 +1,43 @@
+import pickle
+
+# Registers a yaml bool override; the columnar index must not be affected by it
+import project.data.preprocessed  # noqa: F401
+from project.utils import columnar
+
+
+RECORDS = [
+    {'s': 'héllo', 'n': None, 'il': [1, 2], 'sl': ['a', 'b'], 'j': {'k': [1, 'x']},
+     't': (1, 2), 'd': {1: 'a'}, 'm': [1.5]},
+    {'s': '', 'n': 'v', 'il': [], 'sl': [], 'j': None, 't': (3,), 'd': {}, 'extra': 5},
+    {'s': 'z', 'il': [3], 'sl': ['c'], 'j': {'a': 1}, 't': (), 'd': {2: 'b'}, 'm': []},
+]
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / 'split.cols')
+    columnar.save_records(RECORDS, path)
+    assert columnar.is_columnar(path)
+
+    loaded = columnar.load_records(path)
+    assert [dict(r) for r in loaded] == RECORDS
+    assert type(loaded[0]['t']) is tuple
+    assert 'n' not in loaded[2] and 'extra' not in loaded[0]
+
+
+def test_resave_replaces_columns(tmp_path):
+    path = str(tmp_path / 'split.cols')
+    columnar.save_records([{'a': None}, {'a': 'x'}], path)
+    columnar.save_records([{'a': '1'}, {'a': '2'}, {'a': '3'}], path)
+    assert [dict(r) for r in columnar.load_records(path)] == [{'a': '1'}, {'a': '2'}, {'a': '3'}]
+
+
+def test_records_keep_assigned_fields(tmp_path):
+    path = str(tmp_path / 'split.cols')
+    columnar.save_records(RECORDS, path)
+    record = columnar.load_records(path)[0]
+
+    record['new'] = 1
+    copy = record.copy()
+    copy['new'] = 2
+    assert record['new'] == 1
+    assert pickle.loads(pickle.dumps(record)) == dict(record)
@@ -0,0 +1,64 @@
+import os
+
+import pytest
+
+from project.utils import preprocess
+
+
+def _raw_file(package, n, start=0, desc='the value'):
+    lines = []
+    for i in range(start, start + n):
+        lines += ['{}.func_{}:'.format(package, i),
+                  '    args: [x, y, "on"]',
+                  '    arg_info:',
+                  '        x:',
+                  '            desc: {} {}'.format(desc, i),
+                  '            type: int',
+                  '        y:',
+                  '            desc: null',
+                  '            type: null',
+                  '    src: |',
+                  '        def func_{}(x, y, on):'.format(i),
+                  '            return x']
+    return '\n'.join(lines) + '\n'
+
+
+@pytest.fixture
+def data_dirs(tmp_path, monkeypatch):
+    raw, out = tmp_path / 'raw', tmp_path / 'preprocessed'
+    out.mkdir()
+    for t in ['full', 'short']:
+        (raw / t).mkdir(parents=True)
+        for j, package in enumerate(['numpy', 'abc', 'zlib', 'pandas', 'abc2']):
+            (raw / t / '{}.yaml'.format(package)).write_text(_raw_file(package, 6 + j), encoding='utf-8')
+        # Overrides some of abc's records
+        (raw / t / 'abc_patch.yaml').write_text(_raw_file('abc', 3, start=2, desc='patched'), encoding='utf-8')
+        (raw / t / 'error.yaml').write_text('not: [valid', encoding='utf-8')
+    monkeypatch.setattr(preprocess, 'RAWDATADIR', str(raw))
+    monkeypatch.setattr(preprocess, 'PREPROCESSDATADIR', str(out))
+    return raw, out
+
+
+def _outputs(out):
+    return {name: (out / name).read_bytes() for name in ['all_full.yaml', 'all_short.yaml', 'index.txt']}
+
+
+@pytest.mark.parametrize('fan_in', [64, 2])
+def test_incremental_matches_full(data_dirs, monkeypatch, fan_in):
+    raw, out = data_dirs
+    monkeypatch.setattr(preprocess, 'MERGE_FAN_IN', fan_in)
+
+    preprocess.assimilate_data()
+    expected = _outputs(out)
+    assert b'patched 3' in expected['all_full.yaml']
+
+    preprocess.assimilate_data_incremental()
+    assert _outputs(out) == expected
+
+    # Again from the cached shards, after changing one raw file
+    (raw / 'full' / 'zlib.yaml').write_text(_raw_file('zlib', 4, desc='changed'), encoding='utf-8')
+    preprocess.assimilate_data()
+    expected = _outputs(out)
+    preprocess.assimilate_data_incremental()
+    assert _outputs(out) == expected
+    assert not os.path.exists(str(out / 'assimilated' / 'full.merge'))